@@ -6,6 +6,11 @@ import time
 import logging
 import vtk, qt, ctk, slicer
 import sys, subprocess
+import configparser
+import traceback
+import json
+from pathlib import Path
+from urllib.request import urlopen
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 from SegmentStatisticsPlugins import *
@@ -113,6 +118,7 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.isNiiGzFormat = False
         self.checkForUpdates = True
         self.resetmode = False
+        self._iniFilePath = None
         
 
 
@@ -293,18 +299,19 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         self.reportFolder = ""
 
-        import configparser
-        parser = configparser.SafeConfigParser()
-        parser.read(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI')
+        # LCTA.INI is stored next to the Slicer user settings file (same file name prefix)
+        self._iniFilePath = Path(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI')
+
+        parser = configparser.ConfigParser()
+        parser.read(self._iniFilePath)
         if parser.has_option('reportFolder', 'path'): 
             self.reportFolder = parser.get('reportFolder','path')
         else: 
             self.reportFolder = f"{slicer.app.defaultScenePath}/LungCTAnalyzerReports/"
-            from pathlib import Path
             Path(self.reportFolder).mkdir(parents=True, exist_ok=True)
             parser.add_section('reportFolder')
             parser.set('reportFolder', 'path', self.reportFolder)
-            with open(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI', 'w') as configfile:    # save
+            with open(self._iniFilePath, 'w') as configfile:    # save
                 parser.write(configfile)
 
         self.ui.selectReportDirectoryButton.directory = self.reportFolder
@@ -315,7 +322,7 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             parser.add_section('Updates')
             parser.set('Updates', 'check', str(True))
             self.checkForUpdates = True
-            with open(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI', 'w') as configfile:    # save
+            with open(self._iniFilePath, 'w') as configfile:    # save
                 parser.write(configfile)
 
 
@@ -381,9 +388,6 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.versionLabel.text = self.versionText
         
         # show uses 
-        import os
-        import requests
-
         def get_users(program):
             try:
               url = 'http://scientific-networks.de/get_users.php'
@@ -402,9 +406,6 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         
         
         
-        from urllib.request import urlopen
-        import json
-        
         if self.checkForUpdates: 
             link = "https://github.com/rbumm/SlicerLungCTAnalyzer/blob/master/version.json?raw=true"
             try:
@@ -431,9 +432,8 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         self.removeObservers()
  
-        import configparser
-        parser = configparser.SafeConfigParser()
-        parser.read(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI')
+        parser = configparser.ConfigParser()
+        parser.read(self._iniFilePath)
 
         if parser.has_option('Updates', 'check'): 
             if self.checkForUpdates: 
@@ -446,7 +446,7 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 parser.set('Updates','check',str(True))
             else: 
                 parser.set('Updates','check',str(False))
-        with open(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI', 'w') as configfile:    # save
+        with open(self._iniFilePath, 'w') as configfile:    # save
             parser.write(configfile)
 
 
@@ -1321,7 +1321,6 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         except Exception as e:
             qt.QApplication.restoreOverrideCursor()
             slicer.util.errorDisplay("Failed to compute results: "+str(e))
-            import traceback
             traceback.print_exc()
 
     def onOpenReportDirectoryButton(self):
@@ -1335,15 +1334,14 @@ class LungCTAnalyzerWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         logging.info("Directory changed")
         self.reportFolder = self.ui.selectReportDirectoryButton.directory
         # save new path locally
-        import configparser
-        parser = configparser.SafeConfigParser()
-        parser.read(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI')
+        parser = configparser.ConfigParser()
+        parser.read(self._iniFilePath)
         if parser.has_option('reportFolder', 'path'): 
             parser.set('reportFolder', 'path', self.reportFolder)
         else: 
             parser.add_section('reportFolder')
             parser.set('reportFolder', 'path', self.reportFolder)
-        with open(slicer.app.slicerUserSettingsFilePath + 'LCTA.INI', 'w') as configfile:    # save
+        with open(self._iniFilePath, 'w') as configfile:    # save
             parser.write(configfile)
 
     def onSelectReportDirectoryButton(self):
@@ -2197,7 +2195,6 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         
     def saveExtendedDataToFile(self, filename,user_str1,user_str2,user_str3):
 
-        import os.path
 
 
         file_exists = os.path.isfile(filename)
@@ -2306,7 +2303,6 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         
     def saveExtendedRegionDataToFile(self, filename,user_str1,user_str2,user_str3):
 
-        import os.path
 
         file_exists = os.path.isfile(filename)
 
@@ -2386,7 +2382,6 @@ class LungCTAnalyzerLogic(ScriptedLoadableModuleLogic):
         
     def saveExtendedLobeDataToFile(self, filename,user_str1,user_str2,user_str3):
 
-        import os.path
 
         file_exists = os.path.isfile(filename)
 
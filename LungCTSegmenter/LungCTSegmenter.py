@@ -1,16 +1,26 @@
 import os
+import contextlib
+import csv
+import gc
+import hashlib
 import requests
 import sys
+import subprocess
+import tempfile
 import time
 import glob
 import unittest
 import logging
+import traceback
+import numpy as np
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
 import SimpleITK as sitk
 import sitkUtils
+import SampleData
+import SegmentStatistics
 
 
 #
@@ -51,6 +61,138 @@ and<br>
 
     # Sample data is already registered by LungCTAnalyzer module, so there is no need to add here
 
+#
+# Helpers
+#
+
+# Airway segmentation detail levels offered in the GUI and the corresponding
+# minimum airway diameter (mm) used by the Local Threshold effect
+AIRWAY_DETAIL_LEVEL_MINIMUM_DIAMETER_MM = {
+  "very low detail": "5",
+  "low detail": "4",
+  "medium low detail": "3",
+  "medium detail": "2",
+  "high detail": "1",
+  }
+
+# Terminology entries (DICOM anatomic codes) set as segment tags, by segment name
+ANATOMICAL_TERMINOLOGY = {
+  "right lung":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^39607008^Lung"
+    "~SCT^24028007^Right"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "left lung":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^39607008^Lung"
+    "~SCT^7771000^Left"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "left upper lobe":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^45653009^Upper lobe of Lung"
+    "~SCT^7771000^Left"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "left lower lobe":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^90572001^Lower lobe of lung"
+    "~SCT^7771000^Left"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "right upper lobe":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^45653009^Upper lobe of lung"
+    "~SCT^24028007^Right"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "right middle lobe":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^72481006^Middle lobe of right lung"
+    "~^^"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "right lower lobe":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^90572001^Lower lobe of lung"
+    "~SCT^24028007^Right"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  "airways":
+    "Segmentation category and type - 3D Slicer General Anatomy list"
+    "~SCT^123037004^Anatomical Structure"
+    "~SCT^44567001^Trachea"
+    "~^^"
+    "~Anatomic codes - DICOM master list"
+    "~^^"
+    "~^^",
+  }
+
+# Imported TotalSegmentator segments that are smoothed and shown semitransparent in 3D
+SMOOTHED_TOTALSEGMENTATOR_SEGMENTS = frozenset((
+  "right upper lobe",
+  "right middle lobe",
+  "right lower lobe",
+  "left upper lobe",
+  "left lower lobe",
+  "lung",
+  "lung vessels",
+  ))
+
+# AI engines offered in the GUI
+AI_ENGINES = (
+  "lungmask R231", 
+  "lungmask LTRCLobes", 
+  "lungmask LTRCLobes_R231", 
+  "lungmask R231CovidWeb", 
+  "MONAILabel", 
+  "TotalSegmentator lung basic", 
+  "TotalSegmentator lung extended", 
+  )
+
+# AI engines that segment the lung lobes instead of the right and left lung
+LOBE_AI_ENGINES = frozenset((
+  "lungmask LTRCLobes", 
+  "lungmask LTRCLobes_R231", 
+  "MONAILabel", 
+  "TotalSegmentator lung basic", 
+  "TotalSegmentator lung extended", 
+  ))
+
+@contextlib.contextmanager
+def batchedModify(node):
+  """Combine all modifications of a MRML node in the with block into a single Modified event."""
+  wasModified = node.StartModify()
+  try:
+    yield node
+  finally:
+    node.EndModify(wasModified)
+
+def _setIfChanged(widget, propertyName, value):
+  """Set a widget property only if its value is different, to avoid emitting needless change signals."""
+  if getattr(widget, propertyName) != value:
+    setattr(widget, propertyName, value)
+
+def _setCurrentNodeIfChanged(widget, node):
+  """Select a node in a node selector widget only if it is not selected already."""
+  if widget.currentNode() != node:
+    widget.setCurrentNode(node)
+
 #
 # LungCTSegmenterWidget
 #
@@ -72,6 +214,9 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self._leftLungFiducials = None
       self._tracheaFiducials = None
       self._updatingGUIFromParameterNode = False
+      self._guiUpdatePending = False
+      self._startingSegmentation = False
+      self._lastInstructions = None
       self.createDetailedAirways = False
       self.createVessels = False
       self.useAI = False
@@ -98,6 +243,10 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.lungThresholdMax = 0. 
       self.vesselThresholdMin = 0.
       self.vesselThresholdMax = 0.
+
+      self._settings = None
+      self._settingsWriteTimer = None
+      self._lastWrittenSettings = None
  
   
   class checkboxDetails: 
@@ -185,20 +334,8 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           self.ui.label_lcts.text = usage_text
 
       # Populate comboboxes
-      list = ["very low detail","low detail", "medium low detail", "medium detail", "high detail"]
-      self.ui.detailLevelComboBox.addItems(list);
-
-      list = [
-        "lungmask R231", 
-        "lungmask LTRCLobes", 
-        "lungmask LTRCLobes_R231", 
-        "lungmask R231CovidWeb", 
-        "MONAILabel", 
-        "TotalSegmentator lung basic", 
-        "TotalSegmentator lung extended", 
-        ]
-        
-      self.ui.engineAIComboBox.addItems(list);
+      self.ui.detailLevelComboBox.addItems(list(AIRWAY_DETAIL_LEVEL_MINIMUM_DIAMETER_MM.keys()))
+      self.ui.engineAIComboBox.addItems(list(AI_ENGINES))
 
       # Connections
 
@@ -256,7 +393,13 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self.ui.toggleVolumeRenderingVisibilityButton.connect('clicked(bool)', self.onToggleVolumeRenderingVisibilityButton)
       self.ui.engineAIComboBox.enabled = False
       
-      settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
+      # Settings are kept open for the lifetime of the widget and written back with a delay,
+      # so that dragging a slider does not rewrite the settings file on every value change.
+      self._settings = settings = qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
+      self._settingsWriteTimer = qt.QTimer()
+      self._settingsWriteTimer.setSingleShot(True)
+      self._settingsWriteTimer.setInterval(500)
+      self._settingsWriteTimer.connect('timeout()', self.writeSettings)
 
       self.ui.inputDirectoryPathLineEdit.currentPath = settings.value("LungCtSegmenter/batchProcessingInputFolder", "")      
       self.ui.outputDirectoryPathLineEdit.currentPath = settings.value("LungCtSegmenter/batchProcessingOutputFolder", "")
@@ -293,13 +436,15 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           self.calibrateData = eval(settings.value("LungCtSegmenter/calibrateDataCheckBoxChecked", ""))
           self.ui.calibrateDataCheckBox.checked = eval(settings.value("LungCtSegmenter/calibrateDataCheckBoxChecked", ""))
 
+      # Only values that differ from what was just read will be written back
+      self._lastWrittenSettings = self.settingsValues()
+
       # Make sure parameter node is initialized (needed for module reload)
       
       self.initializeParameterNode()
       slicer.app.applicationLogic().FitSliceToAll()
 
-      # Initial GUI update
-      self.updateGUIFromParameterNode()
+      # Initial GUI update is done by setParameterNode
       self.ui.toggleSegmentationVisibilityButton.enabled = False
       self.ui.toggleVolumeRenderingVisibilityButton.enabled = False
       self.ui.VolumeRenderingShiftSliderWidget.enabled = False
@@ -318,9 +463,15 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       """
       Called when the application closes and the module widget is destroyed.
       """
+      # Flush settings only if a write is still pending, do not persist values the user never changed
+      if self._settingsWriteTimer and self._settingsWriteTimer.isActive():
+          self._settingsWriteTimer.stop()
+          self.writeSettings()
       self.removeFiducialObservers()
       self.removeObservers()
       # self.removeKeyboardShortcuts()
+      if self.logic:
+          self.logic.shutdown()
       self.logic = None
 
   def enter(self):
@@ -373,13 +524,11 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def onInputDirectoryPathLineEditChanged(self):
       self.batchProcessingInputDir = self.ui.inputDirectoryPathLineEdit.currentPath
-      settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
-      settings.setValue("LungCtSegmenter/batchProcessingInputFolder", self.ui.inputDirectoryPathLineEdit.currentPath);
+      self._settings.setValue("LungCtSegmenter/batchProcessingInputFolder", self.ui.inputDirectoryPathLineEdit.currentPath);
 
   def onOutputDirectoryPathLineEditChanged(self):
       self.batchProcessingOutputDir = self.ui.outputDirectoryPathLineEdit.currentPath
-      settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
-      settings.setValue("LungCtSegmenter/batchProcessingOutputFolder", self.ui.outputDirectoryPathLineEdit.currentPath);
+      self._settings.setValue("LungCtSegmenter/batchProcessingOutputFolder", self.ui.outputDirectoryPathLineEdit.currentPath);
 
   def showStatusMessage(self, msg, timeoutMsec=500):
       slicer.util.showStatusMessage(msg, timeoutMsec)
@@ -403,7 +552,7 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           self.showCriticalError("Input and output directotry can not be the same path.")
       if not self.useAI:
           self.showCriticalError("Batch processing can only be done with 'Use AI' checked.")
-      if self.createDetailedAirways and not (self.useAI and self.logic.engineAI.find("TotalSegmentator") == 0):
+      if self.createDetailedAirways and not (self.useAI and self.logic.engineAI.startswith("TotalSegmentator")):
           self.showCriticalError("Batch processing can not be used with  Local Threshold airway analysis.")
       if not os.path.exists(self.batchProcessingInputDir):
           self.showCriticalError("Input folder does not exist.")
@@ -474,7 +623,6 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
               import torch
               torch.cuda.empty_cache() 
               
-              import gc
               gc.collect()
               
               try:
@@ -490,7 +638,7 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
               slicer.app.processEvents()
               time.sleep(5)
 
-              if self.useAI and (not self.createDetailedAirways or (self.createDetailedAirways and self.useAI and self.logic.engineAI.find("TotalSegmentator") == 0)):
+              if self.useAI and (not self.createDetailedAirways or (self.createDetailedAirways and self.useAI and self.logic.engineAI.startswith("TotalSegmentator"))):
                   self.onStartButton()
               else:
                   print("Unable to batch process CT, AI must be enabled and/or airway segmentation can not be checked.")
@@ -601,6 +749,11 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       if inputParameterNode:
         self.logic.setDefaultParameters(inputParameterNode)
 
+      if inputParameterNode == self._parameterNode and (inputParameterNode is None
+          or self.hasObserver(inputParameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)):
+          # Already observed, the GUI is kept up-to-date by the observer
+          return
+
       # Unobserve previously selected parameter node and add an observer to the newly selected.
       # Changes of parameter node are observed so that whenever parameters are changed by a script or any other module
       # those are reflected immediately in the GUI.
@@ -613,10 +766,27 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       # Initial GUI update
       self.updateGUIFromParameterNode()
 
-  def setInstructions(self, text):
+  def setViewLayout(self, layout):
+      """
+      Switch the view layout. Nothing is done if the layout is already active,
+      as a layout change relayouts all the views.
+      """
+      layoutManager = slicer.app.layoutManager()
+      if layoutManager.layout != layout:
+          layoutManager.setLayout(layout)
+
+  def setInstructions(self, text, processEvents=False):
+      """
+      Show instructions to the user. Set processEvents to True to make the text visible
+      before a long blocking operation starts.
+      """
+      if text == self._lastInstructions:
+          return
+      self._lastInstructions = text
       #self.ui.instructionsLabel.text = f"<h1><b>{text}</b></h1>"
       self.ui.instructionsLabel.setHtml(f"<h1><b>{text}</b></h1>")
-      slicer.app.processEvents()
+      if processEvents:
+          slicer.app.processEvents()
 
   def setInstructionPlaceMorePoints(self, location, startingFrom, target, current):
       numberOfPointsToPlace = target - current
@@ -637,97 +807,104 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self._updatingGUIFromParameterNode = True
 
       # Update node selectors and sliders
-      self.ui.inputVolumeSelector.setCurrentNode(self.logic.inputVolume)
-      self.ui.outputSegmentationSelector.setCurrentNode(self.logic.outputSegmentation)
+      _setCurrentNodeIfChanged(self.ui.inputVolumeSelector, self.logic.inputVolume)
+      _setCurrentNodeIfChanged(self.ui.outputSegmentationSelector, self.logic.outputSegmentation)
 
-      self.ui.rightLungPlaceWidget.setCurrentNode(self.logic.rightLungFiducials)
-      self.ui.leftLungPlaceWidget.setCurrentNode(self.logic.leftLungFiducials)
-      self.ui.tracheaPlaceWidget.setCurrentNode(self.logic.tracheaFiducials)
+      _setCurrentNodeIfChanged(self.ui.rightLungPlaceWidget, self.logic.rightLungFiducials)
+      _setCurrentNodeIfChanged(self.ui.leftLungPlaceWidget, self.logic.leftLungFiducials)
+      _setCurrentNodeIfChanged(self.ui.tracheaPlaceWidget, self.logic.tracheaFiducials)
       
       # Display instructions
       isSufficientNumberOfPointsPlaced = False
       if not self.logic.segmentationStarted or not self.logic.rightLungFiducials or not self.logic.leftLungFiducials or not self.logic.tracheaFiducials:
           # Segmentation has not started yet
-          self.ui.adjustPointsGroupBox.enabled = False
+          _setIfChanged(self.ui.adjustPointsGroupBox, "enabled", False)
           if not self.logic.inputVolume:
               self.setInstructions("Select input volume.")
           else:
               self.setInstructions('Click "Start" to initiate point placement.')
       else:
-          slicer.app.processEvents()
           rightLungF = self.logic.rightLungFiducials.GetNumberOfDefinedControlPoints()
           leftLungF = self.logic.leftLungFiducials.GetNumberOfDefinedControlPoints()
           tracheaF = self.logic.tracheaFiducials.GetNumberOfDefinedControlPoints()
           #print(" R " + str(rightLungF) + " L " + str(leftLungF) + " T " + str(tracheaF))
           
           # Segmentation is in progress
-          self.ui.adjustPointsGroupBox.enabled = True
-          if  rightLungF < 3 and not self.useAI:
-              self.setInstructionPlaceMorePoints("right lung", 0, 3, rightLungF)
-              self.ui.rightLungPlaceWidget.placeModeEnabled = True
-              slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
-          elif leftLungF < 3 and not self.useAI:
-              self.setInstructionPlaceMorePoints("left lung", 0, 3, leftLungF)
-              self.ui.leftLungPlaceWidget.placeModeEnabled = True
-              slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
-          elif rightLungF < 6 and not self.useAI:
-              self.setInstructionPlaceMorePoints("right lung", 3, 6, rightLungF)
-              self.ui.rightLungPlaceWidget.placeModeEnabled = True
-              slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpGreenSliceView)
-          elif leftLungF < 6 and not self.useAI:
-              self.setInstructionPlaceMorePoints("left lung", 3, 6, leftLungF)
-              self.ui.leftLungPlaceWidget.placeModeEnabled = True
-              slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpGreenSliceView)
-          elif tracheaF < 1:
-              if self.useAI and not self.createDetailedAirways: 
-                 # no trachea markup needed, so skip placement
-                 pass
-              elif self.createDetailedAirways and self.useAI and self.logic.engineAI.find("TotalSegmentator") == 0:
-                 # markup will be generated from TS trachea centroid
-                 pass
-              else: 
-                  self.setInstructionPlaceMorePoints("trachea", 0, 1, tracheaF)
-                  self.ui.tracheaPlaceWidget.placeModeEnabled = True
-                  slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpGreenSliceView)
+          _setIfChanged(self.ui.adjustPointsGroupBox, "enabled", True)
+
+          # Trachea point is not needed if AI is used without airway analysis or
+          # if the trachea markup is generated from the TotalSegmentator trachea centroid
+          isTracheaPointRequired = not self.useAI or (self.createDetailedAirways and not self.logic.engineAI.startswith("TotalSegmentator"))
+
+          # Point placement steps in the order the user is guided through them:
+          # (location, points placed before this step, required points, current points, place widget, layout)
+          redLayout = slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView
+          greenLayout = slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpGreenSliceView
+          placementSteps = []
+          if not self.useAI:
+              placementSteps += [
+                  ("right lung", 0, 3, rightLungF, self.ui.rightLungPlaceWidget, redLayout),
+                  ("left lung", 0, 3, leftLungF, self.ui.leftLungPlaceWidget, redLayout),
+                  ("right lung", 3, 6, rightLungF, self.ui.rightLungPlaceWidget, greenLayout),
+                  ("left lung", 3, 6, leftLungF, self.ui.leftLungPlaceWidget, greenLayout),
+                  ]
+          if isTracheaPointRequired:
+              placementSteps.append(("trachea", 0, 1, tracheaF, self.ui.tracheaPlaceWidget, greenLayout))
+
+          for location, startingFrom, target, current, placeWidget, layout in placementSteps:
+              if current < target:
+                  self.setInstructionPlaceMorePoints(location, startingFrom, target, current)
+                  _setIfChanged(placeWidget, "placeModeEnabled", True)
+                  self.setViewLayout(layout)
+                  break
           else:
-              if self.useAI:
-                  self.setInstructions('Click "Apply" to finalize.')
-                  self.ui.tracheaPlaceWidget.placeModeEnabled = False
-                  self.ui.adjustPointsGroupBox.enabled = True
+              if tracheaF < 1 and not isTracheaPointRequired:
+                  # no trachea markup needed, so skip placement
+                  pass
               else:
-                  self.setInstructions('Verify that segmentation is complete. Click "Apply" to finalize.')
-              slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
-              self.isSufficientNumberOfPointsPlaced = True
-
-      self.ui.startButton.enabled = not self.logic.segmentationStarted
-      self.ui.cancelButton.enabled = self.logic.segmentationStarted
-      self.ui.updateIntensityButton.enabled = self.logic.segmentationStarted
-      self.ui.applyButton.enabled = self.isSufficientNumberOfPointsPlaced
-      if self.logic.segmentationFinished: 
-        self.ui.applyButton.enabled = False
-        self.ui.cancelButton.enabled = True
-        self.ui.startButton.enabled = False
+                  if self.useAI:
+                      self.setInstructions('Click "Apply" to finalize.')
+                      _setIfChanged(self.ui.tracheaPlaceWidget, "placeModeEnabled", False)
+                  else:
+                      self.setInstructions('Verify that segmentation is complete. Click "Apply" to finalize.')
+                  self.setViewLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
+                  self.isSufficientNumberOfPointsPlaced = True
+
+      if self._startingSegmentation:
+        # Segmentation is being initialized (events are processed meanwhile), keep the buttons disabled
+        for button in [self.ui.startButton, self.ui.applyButton, self.ui.cancelButton, self.ui.updateIntensityButton]:
+          _setIfChanged(button, "enabled", False)
+      elif self.logic.segmentationFinished: 
+        _setIfChanged(self.ui.startButton, "enabled", False)
+        _setIfChanged(self.ui.cancelButton, "enabled", True)
+        _setIfChanged(self.ui.applyButton, "enabled", False)
+      else:
+        _setIfChanged(self.ui.startButton, "enabled", not self.logic.segmentationStarted)
+        _setIfChanged(self.ui.cancelButton, "enabled", self.logic.segmentationStarted)
+        _setIfChanged(self.ui.applyButton, "enabled", self.isSufficientNumberOfPointsPlaced)
+      if not self._startingSegmentation:
+        _setIfChanged(self.ui.updateIntensityButton, "enabled", self.logic.segmentationStarted)
         
-      self.ui.detailedAirwaysCheckBox.checked = self.createDetailedAirways
-      self.ui.createVesselsCheckBox.checked = self.createVessels
-      self.ui.useAICheckBox.checked = self.useAI     
-      self.ui.fastCheckBox.checked = self.fastOption
-      self.ui.updateLungmaskCheckBox.checked = self.logic.updateAI
-      self.ui.smoothLungsCheckBox.checked = self.smoothLungs
-
-      self.ui.calibrateDataCheckBox.checked = self.calibrateData
+      _setIfChanged(self.ui.detailedAirwaysCheckBox, "checked", self.createDetailedAirways)
+      _setIfChanged(self.ui.createVesselsCheckBox, "checked", self.createVessels)
+      _setIfChanged(self.ui.useAICheckBox, "checked", self.useAI)
+      _setIfChanged(self.ui.fastCheckBox, "checked", self.fastOption)
+      _setIfChanged(self.ui.updateLungmaskCheckBox, "checked", self.logic.updateAI)
+      _setIfChanged(self.ui.smoothLungsCheckBox, "checked", self.smoothLungs)
+
+      _setIfChanged(self.ui.calibrateDataCheckBox, "checked", self.calibrateData)
       # self.ui.calibrateDataCheckBox.checked = False
       
-      self.ui.testModeCheckBox.checked = self.batchProcessingTestMode
-      self.ui.niigzFormatCheckBox.checked = self.isNiiGzFormat
-      self.ui.shrinkMasksCheckBox.checked = self.shrinkMasks
-      self.ui.detailedMasksCheckBox.checked = self.detailedMasks
-      self.ui.saveFiducialsCheckBox.checked = self.saveFiducials
-      self.ui.detailLevelComboBox.currentText = self.logic.airwaySegmentationDetailLevel
-      self.ui.engineAIComboBox.currentText = self.logic.engineAI      
-      self.ui.VolumeRenderingShiftSliderWidget.value = self.VolumeRenderingShift
-      self.ui.LungThresholdRangeWidget.minimumValue = self.lungThresholdMin
-      self.ui.LungThresholdRangeWidget.maximumValue = self.lungThresholdMax 
+      _setIfChanged(self.ui.testModeCheckBox, "checked", self.batchProcessingTestMode)
+      _setIfChanged(self.ui.niigzFormatCheckBox, "checked", self.isNiiGzFormat)
+      _setIfChanged(self.ui.shrinkMasksCheckBox, "checked", self.shrinkMasks)
+      _setIfChanged(self.ui.detailedMasksCheckBox, "checked", self.detailedMasks)
+      _setIfChanged(self.ui.saveFiducialsCheckBox, "checked", self.saveFiducials)
+      _setIfChanged(self.ui.detailLevelComboBox, "currentText", self.logic.airwaySegmentationDetailLevel)
+      _setIfChanged(self.ui.engineAIComboBox, "currentText", self.logic.engineAI)
+      _setIfChanged(self.ui.VolumeRenderingShiftSliderWidget, "value", self.VolumeRenderingShift)
+      _setIfChanged(self.ui.LungThresholdRangeWidget, "minimumValue", self.lungThresholdMin)
+      _setIfChanged(self.ui.LungThresholdRangeWidget, "maximumValue", self.lungThresholdMax)
 
       self.updateFiducialObservations(self._rightLungFiducials, self.logic.rightLungFiducials)
       self.updateFiducialObservations(self._leftLungFiducials, self.logic.leftLungFiducials)
@@ -755,6 +932,17 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       # region growing, which would take time)
       slicer.modules.markups.logic().SetAllControlPointsLocked(caller, True)
 
+      # Point events may arrive in bursts (e.g., when points are pasted or loaded),
+      # refresh the GUI and the segmentation preview only once, when control returns to the event loop.
+      if not self._guiUpdatePending:
+          self._guiUpdatePending = True
+          qt.QTimer.singleShot(0, self._flushGuiUpdate)
+
+  def _flushGuiUpdate(self):
+      self._guiUpdatePending = False
+      if self.logic is None or self._startingSegmentation:
+          # onStartButton updates the GUI and the segmentation when initialization is completed
+          return
       self.updateGUIFromParameterNode()
       if self.isSufficientNumberOfPointsPlaced: 
           self.logic.updateSegmentation()
@@ -768,73 +956,96 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       if self._parameterNode is None or self.logic is None or self._updatingGUIFromParameterNode:
           return
 
-      wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
-
-      settings=qt.QSettings(slicer.app.launcherSettingsFilePath, qt.QSettings.IniFormat)
-
-      self.logic.inputVolume = self.ui.inputVolumeSelector.currentNode()
-      self.logic.outputSegmentation = self.ui.outputSegmentationSelector.currentNode()
-      self.VolumeRenderingShift = self.ui.VolumeRenderingShiftSliderWidget.value
-      self.lungThresholdMin = self.ui.LungThresholdRangeWidget.minimumValue
-      settings.setValue("LungCtSegmenter/lungThresholdRangeMinimumValue", str(self.ui.LungThresholdRangeWidget.minimumValue))
-      self.lungThresholdMax = self.ui.LungThresholdRangeWidget.maximumValue
-      settings.setValue("LungCtSegmenter/lungThresholdRangeMaximumValue", str(self.ui.LungThresholdRangeWidget.maximumValue))
-      self.vesselThresholdMin = self.ui.VesselThresholdRangeWidget.minimumValue
-      settings.setValue("LungCtSegmenter/vesselThresholdRangeMinimumValue", str(self.ui.VesselThresholdRangeWidget.minimumValue))
-      self.vesselThresholdMax = self.ui.VesselThresholdRangeWidget.maximumValue
-      settings.setValue("LungCtSegmenter/vesselThresholdRangeMaximumValue", str(self.ui.VesselThresholdRangeWidget.maximumValue))
-      self.createDetailedAirways = self.ui.detailedAirwaysCheckBox.checked 
-      self.createVessels = self.ui.createVesselsCheckBox.checked 
-      self.useAI = self.ui.useAICheckBox.checked 
-      self.fastOption = self.ui.fastCheckBox.checked 
-      settings.setValue("LungCtSegmenter/fastCheckBoxChecked", str(self.smoothLungs))
-      self.logic.updateAI = self.ui.updateLungmaskCheckBox.checked
+      with batchedModify(self._parameterNode):  # Modify all properties in a single batch
+          self.logic.inputVolume = self.ui.inputVolumeSelector.currentNode()
+          self.logic.outputSegmentation = self.ui.outputSegmentationSelector.currentNode()
+          self.VolumeRenderingShift = self.ui.VolumeRenderingShiftSliderWidget.value
+          self.lungThresholdMin = self.ui.LungThresholdRangeWidget.minimumValue
+          self.lungThresholdMax = self.ui.LungThresholdRangeWidget.maximumValue
+          self.vesselThresholdMin = self.ui.VesselThresholdRangeWidget.minimumValue
+          self.vesselThresholdMax = self.ui.VesselThresholdRangeWidget.maximumValue
+          self.createDetailedAirways = self.ui.detailedAirwaysCheckBox.checked 
+          self.createVessels = self.ui.createVesselsCheckBox.checked 
+          self.useAI = self.ui.useAICheckBox.checked 
+          self.fastOption = self.ui.fastCheckBox.checked 
+          self.logic.updateAI = self.ui.updateLungmaskCheckBox.checked
       
-      self.batchProcessingTestMode = self.ui.testModeCheckBox.checked
-      settings.setValue("LungCtSegmenter/testModeCheckBoxChecked", str(self.batchProcessingTestMode))
+          self.batchProcessingTestMode = self.ui.testModeCheckBox.checked
         
-      self.isNiiGzFormat = self.ui.niigzFormatCheckBox.checked 
-      settings.setValue("LungCtSegmenter/niigzFormatCheckBoxChecked", str(self.isNiiGzFormat))
+          self.isNiiGzFormat = self.ui.niigzFormatCheckBox.checked 
 
-      self.smoothLungs = self.ui.smoothLungsCheckBox.checked 
-      settings.setValue("LungCtSegmenter/smoothLungsCheckBoxChecked", str(self.smoothLungs))
+          self.smoothLungs = self.ui.smoothLungsCheckBox.checked 
         
-      # switched off for testing
-      # self.calibrateData = False
-      # self.ui.calibrateDataCheckBox.checked = False
-
-      self.calibrateData = self.ui.calibrateDataCheckBox.checked 
-      settings.setValue("LungCtSegmenter/calibrateDataCheckBoxChecked", str(self.calibrateData))
-
-      self.ui.engineAIComboBox.enabled = self.useAI
-      self.shrinkMasks = self.ui.shrinkMasksCheckBox.checked 
-      self.detailedMasks = self.ui.detailedMasksCheckBox.checked 
-      self.saveFiducials = self.ui.saveFiducialsCheckBox.checked 
-      self.logic.airwaySegmentationDetailLevel = self.ui.detailLevelComboBox.currentText
-      self.logic.engineAI = self.ui.engineAIComboBox.currentText
+          # switched off for testing
+          # self.calibrateData = False
+          # self.ui.calibrateDataCheckBox.checked = False
+
+          self.calibrateData = self.ui.calibrateDataCheckBox.checked 
+
+          self.ui.engineAIComboBox.enabled = self.useAI
+          self.shrinkMasks = self.ui.shrinkMasksCheckBox.checked 
+          self.detailedMasks = self.ui.detailedMasksCheckBox.checked 
+          self.saveFiducials = self.ui.saveFiducialsCheckBox.checked 
+          self.logic.airwaySegmentationDetailLevel = self.ui.detailLevelComboBox.currentText
+          self.logic.engineAI = self.ui.engineAIComboBox.currentText
       
-      if self.logic.engineAI.find("TotalSegmentator") == 0:
-          self.ui.fastCheckBox.enabled = True
-          self.ui.calibrateDataCheckBox.enabled = True
-      else:
-          self.ui.fastCheckBox.enabled = False
-          self.ui.calibrateDataCheckBox.enabled = False
+          if self.logic.engineAI.startswith("TotalSegmentator"):
+              self.ui.fastCheckBox.enabled = True
+              self.ui.calibrateDataCheckBox.enabled = True
+          else:
+              self.ui.fastCheckBox.enabled = False
+              self.ui.calibrateDataCheckBox.enabled = False
 
-      if self.logic.engineAI.find("lungmask") == 0:
-          self.ui.updateLungmaskCheckBox.enabled = True
-      else:
-          self.ui.updateLungmaskCheckBox.enabled = False
+          if self.logic.engineAI.startswith("lungmask"):
+              self.ui.updateLungmaskCheckBox.enabled = True
+          else:
+              self.ui.updateLungmaskCheckBox.enabled = False
       
-      if self.useAI:
-        self.ui.LungThresholdRangeWidget.enabled = False
-        self.ui.smoothLungsCheckBox.enabled = True
-      else:
-        self.ui.LungThresholdRangeWidget.enabled = True
-        self.ui.smoothLungsCheckBox.enabled = False
+          if self.useAI:
+            self.ui.LungThresholdRangeWidget.enabled = False
+            self.ui.smoothLungsCheckBox.enabled = True
+          else:
+            self.ui.LungThresholdRangeWidget.enabled = True
+            self.ui.smoothLungsCheckBox.enabled = False
       
-      self.setOutputVisibilityFromCheckBoxes()
+          self.setOutputVisibilityFromCheckBoxes()
       
-      self._parameterNode.EndModify(wasModified)
+
+      # Restart the timer, settings are written once the user stopped changing values
+      self._settingsWriteTimer.start()
+
+  def settingsValues(self):
+      """
+      Return the persistent GUI choices as a dictionary of settings keys and values.
+      """
+      return {
+        "LungCtSegmenter/lungThresholdRangeMinimumValue": str(self.lungThresholdMin),
+        "LungCtSegmenter/lungThresholdRangeMaximumValue": str(self.lungThresholdMax),
+        "LungCtSegmenter/vesselThresholdRangeMinimumValue": str(self.vesselThresholdMin),
+        "LungCtSegmenter/vesselThresholdRangeMaximumValue": str(self.vesselThresholdMax),
+        "LungCtSegmenter/fastCheckBoxChecked": str(self.fastOption),
+        "LungCtSegmenter/testModeCheckBoxChecked": str(self.batchProcessingTestMode),
+        "LungCtSegmenter/niigzFormatCheckBoxChecked": str(self.isNiiGzFormat),
+        "LungCtSegmenter/smoothLungsCheckBoxChecked": str(self.smoothLungs),
+        "LungCtSegmenter/calibrateDataCheckBoxChecked": str(self.calibrateData),
+        }
+
+  def writeSettings(self):
+      """
+      Store the persistent GUI choices in the application settings.
+      """
+      if self._startingSegmentation:
+          # Try again later, do not write settings while segmentation is being initialized
+          self._settingsWriteTimer.start()
+          return
+      values = self.settingsValues()
+      if values == self._lastWrittenSettings:
+          # Nothing has changed since the last write (e.g., slider was dragged back)
+          return
+      for key, value in values.items():
+          if self._lastWrittenSettings is None or self._lastWrittenSettings.get(key) != value:
+              self._settings.setValue(key, value)
+      self._lastWrittenSettings = values
 
   def onToggleSegmentationVisibilityButton(self):
       """
@@ -921,24 +1132,33 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             if not fiducialsLoadSuccess: 
                 # otherwise try loading markups from temp directory 
                 fiducialsLoadSuccess = self.loadFiducialsTempDir() 
-          self.setInstructions("Initializing segmentation...")
+          self.setInstructions("Initializing segmentation...", processEvents=True)
           self.isSufficientNumberOfPointsPlaced = False
-          self.ui.updateIntensityButton.enabled = True
-          self.logic.startSegmentation()
-          self.logic.updateSegmentation()
+          # startSegmentation and updateSegmentation process events (background resampling, status messages).
+          # While _startingSegmentation is set the buttons stay disabled and the GUI callbacks do not re-enter the logic.
+          self._startingSegmentation = True
+          try:
+              self.updateGUIFromParameterNode()
+              self.logic.startSegmentation()
+              with batchedModify(self.logic.getParameterNode()):
+                  self.logic.updateSegmentation()
+          finally:
+              self._startingSegmentation = False
+          # segmentationStarted is not stored in the parameter node, so update the GUI (including the buttons) explicitly
           self.updateGUIFromParameterNode()
           self.ui.toggleSegmentationVisibilityButton.enabled = False
           self.ui.toggleVolumeRenderingVisibilityButton.enabled = False
           self.ui.VolumeRenderingShiftSliderWidget.enabled = False
           # if AI checked and no airway segmentation planned no need to place markups so 
           # run processing immediately from the start button
-          if (self.useAI and not self.createDetailedAirways) or (self.useAI and self.createDetailedAirways and self.logic.engineAI.find("TotalSegmentator") == 0):
+          if (self.useAI and not self.createDetailedAirways) or (self.useAI and self.createDetailedAirways and self.logic.engineAI.startswith("TotalSegmentator")):
               self.runProcessing()
           qt.QApplication.restoreOverrideCursor()
       except Exception as e:
           qt.QApplication.restoreOverrideCursor()
+          # Restore the button states
+          self.updateGUIFromParameterNode()
           slicer.util.errorDisplay("Failed to start segmentation: "+str(e))
-          import traceback
           traceback.print_exc()
 
   def enableOutputCheckBox(self,labelname,_checked):
@@ -970,7 +1190,7 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                         structureID = segmentation.GetSegmentIdBySegmentName("left rib " + str(i))
                         self.logic.outputSegmentation.GetDisplayNode().SetSegmentVisibility(structureID,uiid.checked)
                 elif key == "airways":
-                    if self.logic.engineAI.find("TotalSegmentator") == 0:
+                    if self.logic.engineAI.startswith("TotalSegmentator"):
                         segmentation = self.logic.outputSegmentation.GetSegmentation()
                         structureID = segmentation.GetSegmentIdBySegmentName("trachea")
                         self.logic.outputSegmentation.GetDisplayNode().SetSegmentVisibility(structureID,uiid.checked)
@@ -995,10 +1215,14 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
       try:
 
-          self.logic.lungThresholdMin = self.lungThresholdMin
-          self.logic.lungThresholdMax = self.lungThresholdMax 
-          self.logic.vesselThresholdMin = self.vesselThresholdMin
-          self.logic.vesselThresholdMax = self.vesselThresholdMax
+          # Parameter node is modified in a single batch to update the GUI only once
+          with batchedModify(self.logic.getParameterNode()):
+              self.logic.lungThresholdMin = self.lungThresholdMin
+              self.logic.lungThresholdMax = self.lungThresholdMax 
+              self.logic.vesselThresholdMin = self.vesselThresholdMin
+              self.logic.vesselThresholdMax = self.vesselThresholdMax
+              if self.useAI:
+                  self.logic.engineAI = self.ui.engineAIComboBox.currentText
 
           self.logic.detailedAirways = self.createDetailedAirways
           self.logic.createVessels = self.createVessels
@@ -1009,24 +1233,25 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           self.logic.smoothLungs = self.smoothLungs
           self.logic.calibrateData = self.calibrateData
           
-          if self.useAI:
-            self.logic.engineAI = self.ui.engineAIComboBox.currentText
           # always save a copy of the current markups in Slicer temp dir for later use
           self.saveFiducialsTempDir()
           if self.saveFiducials: 
             self.saveFiducialsDataDir()
-          self.setInstructions('Finalizing the segmentation, please wait...')
+          self.setInstructions('Finalizing the segmentation, please wait...', processEvents=True)
           self.logic.shrinkMasks = self.shrinkMasks
           self.logic.detailedMasks = self.detailedMasks
           self.disableAllOutputCheckBoxes()
-          self.logic.applySegmentation()
+          # The GUI is updated by the parameter node observer, once, when the batch ends.
+          # Modified() is needed because segmentationFinished is not stored in the parameter node.
+          with batchedModify(self.logic.getParameterNode()) as parameterNode:
+              self.logic.applySegmentation()
+              parameterNode.Modified()
           segmentationNode = self.logic.outputSegmentation
           segmentationNode.CreateDefaultDisplayNodes()
           segmentationDisplayNode = segmentationNode.GetDisplayNode()
           segmentationDisplayNode.Visibility2DOn()
           segmentationDisplayNode.Visibility3DOn()
           self.volumeRenderingDisplayNode = None
-          self.updateGUIFromParameterNode()
           self.ui.toggleSegmentationVisibilityButton.enabled = True
           self.ui.toggleVolumeRenderingVisibilityButton.enabled = True
           self.ui.VolumeRenderingShiftSliderWidget.enabled = True
@@ -1034,7 +1259,6 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       except Exception as e:
           qt.QApplication.restoreOverrideCursor()
           slicer.util.errorDisplay("Failed to compute results: "+str(e))
-          import traceback
           traceback.print_exc()
       self.setInstructions('')
       self.ui.applyButton.enabled = False
@@ -1058,8 +1282,8 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
           self.enableOutputCheckBox("ribs right", False)
           self.enableOutputCheckBox("ribs left",False)
         
-        if self.logic.engineAI == "TotalSegmentator lung extended" or self.logic.engineAI == "TotalSegmentator lung basic" or self.logic.engineAI == "lungmask LTRCLobes" or self.logic.engineAI == "lungmask LTRCLobes_R231" or self.logic.engineAI == "MONAILabel" :
-          if not self.logic.engineAI.find("lungmask") == 0:
+        if self.logic.engineAI in LOBE_AI_ENGINES:
+          if not self.logic.engineAI.startswith("lungmask"):
             self.enableOutputCheckBox("airways", True)
           self.enableOutputCheckBox("right upper lobe",True)
           self.enableOutputCheckBox("right middle lobe",True)
@@ -1076,6 +1300,8 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       """
       Run processing when user clicks "Apply" button.
       """
+      if self._startingSegmentation:
+          return
       self.runProcessing()
 
 
@@ -1083,54 +1309,53 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       """
       Stop segmentation without applying it.
       """
+      if self._startingSegmentation:
+          # nodes are still being set up by startSegmentation
+          return
       try:
-          self.logic.inputVolume = self.ui.inputVolumeSelector.currentNode()
-          self.isSufficientNumberOfPointsPlaced = False
-          self.disableAllOutputCheckBoxes()
-          self.logic.cancelSegmentation()
-          self.ui.toggleSegmentationVisibilityButton.enabled = False
-          self.ui.toggleVolumeRenderingVisibilityButton.enabled = False
-          self.ui.startButton.enabled = True
-          self.logic.segmentationStarted = False
-          self.logic.segmentationFinished = False
-          self.logic.rightLungFiducials = self.logic.leftLungFiducials = self.logic.tracheaFiducials = None
-          self.ui.outputCollapsibleButton.collapsed = True
-          self.updateGUIFromParameterNode()
-          slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
+          # Parameter node is modified in a single batch to update the GUI only once.
+          # Modified() makes sure the GUI is updated even if no referenced node has changed.
+          with batchedModify(self.logic.getParameterNode()) as parameterNode:
+              self.logic.inputVolume = self.ui.inputVolumeSelector.currentNode()
+              self.isSufficientNumberOfPointsPlaced = False
+              self.disableAllOutputCheckBoxes()
+              self.logic.cancelSegmentation()
+              self.ui.toggleSegmentationVisibilityButton.enabled = False
+              self.ui.toggleVolumeRenderingVisibilityButton.enabled = False
+              self.ui.startButton.enabled = True
+              self.logic.segmentationStarted = False
+              self.logic.segmentationFinished = False
+              self.logic.rightLungFiducials = self.logic.leftLungFiducials = self.logic.tracheaFiducials = None
+              self.ui.outputCollapsibleButton.collapsed = True
+              parameterNode.Modified()
+          self.setViewLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpView)
       except Exception as e:
           slicer.util.errorDisplay("Failed to compute results: "+str(e))
-          import traceback
           traceback.print_exc()
 
   def onUpdateIntensityButton(self):
+      if self._startingSegmentation:
+          return
       self.updateParameterNodeFromGUI()
       self.logic.updateSegmentation()
 
   def _saveFiducials(self, directory):
     try:
-        markupsNode = slicer.mrmlScene.GetFirstNodeByName('R')
-        temporaryStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialStorageNode")
-        temporaryStorageNode.SetFileName(directory+"R.fcsv")
-        temporaryStorageNode.WriteData(markupsNode)
-        slicer.mrmlScene.RemoveNode(temporaryStorageNode)  
-        markupsNode = slicer.mrmlScene.GetFirstNodeByName('L')
-        temporaryStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialStorageNode")
-        temporaryStorageNode.SetFileName(directory+"L.fcsv")
-        temporaryStorageNode.WriteData(markupsNode)
-        slicer.mrmlScene.RemoveNode(temporaryStorageNode)  
-        markupsNode = slicer.mrmlScene.GetFirstNodeByName('T')
-        temporaryStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialStorageNode")
-        temporaryStorageNode.SetFileName(directory+"T.fcsv")
-        temporaryStorageNode.WriteData(markupsNode)
-        slicer.mrmlScene.RemoveNode(temporaryStorageNode)  
+        # The storage node is only used for writing, it does not need to be added to the scene
+        temporaryStorageNode = slicer.vtkMRMLMarkupsFiducialStorageNode()
+        # Use the markups nodes referenced by the logic instead of searching the scene by name
+        markupsNodes = (('R', self.logic.rightLungFiducials), ('L', self.logic.leftLungFiducials), ('T', self.logic.tracheaFiducials))
+        for name, markupsNode in markupsNodes:
+            if not markupsNode:
+                continue
+            temporaryStorageNode.SetFileName(directory + name + ".fcsv")
+            temporaryStorageNode.WriteData(markupsNode)
     except Exception as e:
         slicer.util.errorDisplay("Failed to save markups: "+str(e))
-        import traceback
         traceback.print_exc()
       
   def saveFiducialsTempDir(self):
     logging.info("Saving markups in temp directory ...")
-    import os
     directory = slicer.app.temporaryPath + "/LungCTSegmenter/"
     if not os.path.exists(directory):
         os.makedirs(directory)
@@ -1155,39 +1380,30 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             os.makedirs(directory)
         self._saveFiducials(directory)
 
+  def _loadFiducialsFromFile(self, storageNode, file_path, name, color):
+    markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", name)
+    markupsNode.CreateDefaultDisplayNodes()
+    markupsNode.GetDisplayNode().SetSelectedColor(self.logic.brighterColor(color))
+    markupsNode.GetDisplayNode().SetPointLabelsVisibility(True)
+    storageNode.SetFileName(file_path)
+    storageNode.ReadData(markupsNode)
+    return markupsNode
+
   def loadFiducials(self,directory):
     RLoadSuccess = LLoadSuccess = TLoadSuccess = False 
+    # List the directory once instead of checking each markups file separately.
+    # Raises FileNotFoundError if the directory does not exist.
+    presentFiles = {entry.name for entry in os.scandir(directory)}
     temporaryStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialStorageNode")
-    file_path = directory +"/R.fcsv"
-    if os.path.exists(file_path): 
-        if not self.logic.rightLungFiducials:
-            self.logic.rightLungFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "R")
-            self.logic.rightLungFiducials.CreateDefaultDisplayNodes()
-            self.logic.rightLungFiducials.GetDisplayNode().SetSelectedColor(self.logic.brighterColor(self.logic.rightLungColor))
-            self.logic.rightLungFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
-            temporaryStorageNode.SetFileName(file_path)
-            temporaryStorageNode.ReadData(self.logic.rightLungFiducials)
-            RLoadSuccess = True
-    file_path = directory +"/L.fcsv"
-    if os.path.exists(file_path): 
-        if not self.logic.leftLungFiducials:
-            self.logic.leftLungFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "L")
-            self.logic.leftLungFiducials.CreateDefaultDisplayNodes()
-            self.logic.leftLungFiducials.GetDisplayNode().SetSelectedColor(self.logic.brighterColor(self.logic.leftLungColor))
-            self.logic.leftLungFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
-            temporaryStorageNode.SetFileName(file_path)
-            temporaryStorageNode.ReadData(self.logic.leftLungFiducials)
-            LLoadSuccess = True
-    file_path = directory +"/T.fcsv"
-    if os.path.exists(file_path): 
-        if not self.logic.tracheaFiducials:
-            self.logic.tracheaFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "T")
-            self.logic.tracheaFiducials.CreateDefaultDisplayNodes()
-            self.logic.tracheaFiducials.GetDisplayNode().SetSelectedColor(self.logic.brighterColor(self.logic.unknownColor))
-            self.logic.tracheaFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
-            temporaryStorageNode.SetFileName(file_path)
-            temporaryStorageNode.ReadData(self.logic.tracheaFiducials)
-            TLoadSuccess = True
+    if "R.fcsv" in presentFiles and not self.logic.rightLungFiducials:
+        self.logic.rightLungFiducials = self._loadFiducialsFromFile(temporaryStorageNode, directory + "/R.fcsv", "R", self.logic.rightLungColor)
+        RLoadSuccess = True
+    if "L.fcsv" in presentFiles and not self.logic.leftLungFiducials:
+        self.logic.leftLungFiducials = self._loadFiducialsFromFile(temporaryStorageNode, directory + "/L.fcsv", "L", self.logic.leftLungColor)
+        LLoadSuccess = True
+    if "T.fcsv" in presentFiles and not self.logic.tracheaFiducials:
+        self.logic.tracheaFiducials = self._loadFiducialsFromFile(temporaryStorageNode, directory + "/T.fcsv", "T", self.logic.unknownColor)
+        TLoadSuccess = True
     slicer.mrmlScene.RemoveNode(temporaryStorageNode)
     
     if RLoadSuccess and LLoadSuccess and TLoadSuccess:
@@ -1196,24 +1412,25 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         return False 
 
   def loadFiducialsTempDir(self):
-    import os.path
 
     fiducialsLoadSuccess = False
          
     # if not local markups available load last global  
     # logging.info("Loading last markups from temp directory ...")
     directory = slicer.app.temporaryPath + "/LungCTSegmenter/"
-    if os.path.exists(directory): 
+    try:
         fiducialsLoadSuccess = self.loadFiducials(directory)
-        if fiducialsLoadSuccess: 
-            logging.info("Succesfully loaded markups from temp directory.")
-        else:
-            logging.info("Failed to load markups from temp directory.")
+    except FileNotFoundError:
+        # no markups have been saved yet
+        return False
+    if fiducialsLoadSuccess: 
+        logging.info("Succesfully loaded markups from temp directory.")
+    else:
+        logging.info("Failed to load markups from temp directory.")
 
     return fiducialsLoadSuccess
 
   def loadFiducialsDataDir(self):
-    import os.path
 
     fiducialsLoadSuccess = False
     # prefer local markups if available 
@@ -1227,14 +1444,14 @@ class LungCTSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             inputFilename = storageNode.GetFileName()
             head, tail = os.path.split(inputFilename)
             directory = head + "/LungCTSegmenter/"
-            if not os.path.exists(directory):
-                logging.info("No markup directory in data path.")
-            else: 
+            try:
                 fiducialsLoadSuccess = self.loadFiducials(directory)
                 if fiducialsLoadSuccess: 
                     logging.info("Succesfully loaded markups from data directory.")
                 else:
                     logging.info("Failed to load markups from data directory.")
+            except FileNotFoundError:
+                logging.info("No markup directory in data path.")
         else:
             logging.info("No storage node.")
     return fiducialsLoadSuccess
@@ -1258,12 +1475,19 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self._parameterNode = None
         self.outputSegmentation = None
         self.tsOutputSegmentation = None
         self.tsOutputExtendedSegmentation = None
         self.rightLungSegmentId = None
         self.leftLungSegmentId = None
         self.tracheaSegmentId = None
+        # seed positions each seed segment was last built from, and intensity range of the last preview
+        self._seedPositions = {}
+        self._seedsModified = False
+        self._previewIntensityRange = None
+        self._lastProcessEventsTime = 0.
+        self._isShutDown = False
         
         self.rightLungColor = (0.5, 0.68, 0.5)
         self.leftLungColor = (0.95, 0.84, 0.57)
@@ -1308,8 +1532,28 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         self.slope = 0.
         self.intercept = 0.
         
-    def __del__(self):
+    def shutdown(self):
+        """
+        Remove temporary objects and release the segment editor widget.
+        Called when the module widget is cleaned up, calling it again has no effect.
+        """
+        if self._isShutDown:
+            return
+        self._isShutDown = True
         self.removeTemporaryObjects()
+        if self.segmentEditorWidget:
+            self.segmentEditorWidget.setMRMLScene(None)
+            self.segmentEditorWidget.deleteLater()
+            self.segmentEditorWidget = None
+
+    def getParameterNode(self):
+        """
+        Return the parameter node. The scene is only searched again if the
+        previously found node is no longer in the scene (e.g., after scene close).
+        """
+        if self._parameterNode is None or self._parameterNode.GetScene() is not slicer.mrmlScene:
+            self._parameterNode = ScriptedLoadableModuleLogic.getParameterNode(self)
+        return self._parameterNode
 
     def setDefaultParameters(self, parameterNode):
         """
@@ -1438,17 +1682,12 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
     
     def brighterColor(self, rgb):
-        import numpy as np
         scaleFactor = 1.5
-        rgbBrighter = np.array(rgb) * scaleFactor
-        return np.clip(rgbBrighter, 0.0, 1.0)
+        return tuple(min(max(component * scaleFactor, 0.0), 1.0) for component in rgb)
 
     def saveExtendedDataToFile(self,filename,user_str1,user_str2,user_str3):
-        import os.path
         file_exists = os.path.isfile(filename)
 
-        import csv
-
         header = [
         'user1',
         'user2',
@@ -1486,74 +1725,87 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
     def startSegmentation(self):
         if not self.inputVolume:
-          # prevent start
           raise ValueError("No input volume. ")
-          return
         if self.segmentationStarted:
           # Already started
           return
         self.segmentationStarted = True
         self.segmentationFinished = False
         
-        import time
         startTime = time.time()
 
         # Clear previous segmentation
         if self.outputSegmentation:
             self.outputSegmentation.GetSegmentation().RemoveAllSegments()
 
-        if not self.rightLungFiducials:
-            self.rightLungFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "R")
-            self.rightLungFiducials.CreateDefaultDisplayNodes()
-            self.rightLungFiducials.GetDisplayNode().SetSelectedColor(self.brighterColor(self.rightLungColor))
-            self.rightLungFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
-        if not self.leftLungFiducials:
-            self.leftLungFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "L")
-            self.leftLungFiducials.CreateDefaultDisplayNodes()
-            self.leftLungFiducials.GetDisplayNode().SetSelectedColor(self.brighterColor(self.leftLungColor))
-            self.leftLungFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
-        if not self.tracheaFiducials:
-            self.tracheaFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "T")
-            self.tracheaFiducials.CreateDefaultDisplayNodes()
-            self.tracheaFiducials.GetDisplayNode().SetSelectedColor(self.brighterColor(self.unknownColor))
-            self.tracheaFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
-
-        if not self.resampledVolume:
-            self.resampledVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "Resampled Volume")
-
-        # Get window / level of inputVolume 
-        displayNode = self.inputVolume.GetDisplayNode()
-        displayNode.AutoWindowLevelOff()
-        displayNode.SetWindowLevel(1400, -500)
+        # Node references are stored in the parameter node, set them in a single batch
+        with batchedModify(self.getParameterNode()):
+            if not self.resampledVolume:
+                self.resampledVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "Resampled Volume")
+
+            # Get window / level of inputVolume 
+            displayNode = self.inputVolume.GetDisplayNode()
+            displayNode.AutoWindowLevelOff()
+            displayNode.SetWindowLevel(1400, -500)
+
+            # Create resampled volume with fixed 2.0mm spacing (for faster, standardized workflow)
+            # Resampling runs in the background while the nodes and the segment editor are set up.
+
+            self.showStatusMessage('Resampling volume, please wait...')
+            parameters = {"outputPixelSpacing": "2.0,2.0,2.0", "InputVolume": self.inputVolume, "interpolationType": "linear", "OutputVolume": self.resampledVolume}
+            cliParameterNode = slicer.cli.run(slicer.modules.resamplescalarvolume, None, parameters, wait_for_completion=False)
+
+            if not self.rightLungFiducials:
+                self.rightLungFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "R")
+                self.rightLungFiducials.CreateDefaultDisplayNodes()
+                self.rightLungFiducials.GetDisplayNode().SetSelectedColor(self.brighterColor(self.rightLungColor))
+                self.rightLungFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
+            if not self.leftLungFiducials:
+                self.leftLungFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "L")
+                self.leftLungFiducials.CreateDefaultDisplayNodes()
+                self.leftLungFiducials.GetDisplayNode().SetSelectedColor(self.brighterColor(self.leftLungColor))
+                self.leftLungFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
+            if not self.tracheaFiducials:
+                self.tracheaFiducials = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", "T")
+                self.tracheaFiducials.CreateDefaultDisplayNodes()
+                self.tracheaFiducials.GetDisplayNode().SetSelectedColor(self.brighterColor(self.unknownColor))
+                self.tracheaFiducials.GetDisplayNode().SetPointLabelsVisibility(True)
+
+            if not self.outputSegmentation:
+                self.outputSegmentation = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "Lung segmentation")
+                self.outputSegmentation.CreateDefaultDisplayNodes()
+        # We show the current segmentation using markups, so let's hide the display node (seeds)
+        self.rightLungSegmentId = None
+        self.leftLungSegmentId = None
+        self.tracheaSegmentId = None
+        self._seedPositions = {}
+        self._previewIntensityRange = None
+        self.outputSegmentation.GetDisplayNode().SetVisibility(False)
 
-        # Create resampled volume with fixed 2.0mm spacing (for faster, standardized workflow)
+        # Create segment editor to get access to effects (the widget is kept and reused in later runs)
+        if not self.segmentEditorWidget:
+            self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+            self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+        self.segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
+        self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
+        self.segmentEditorWidget.setSegmentationNode(self.outputSegmentation)
 
-        self.showStatusMessage('Resampling volume, please wait...')
-        parameters = {"outputPixelSpacing": "2.0,2.0,2.0", "InputVolume": self.inputVolume, "interpolationType": "linear", "OutputVolume": self.resampledVolume}
-        cliParameterNode = slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, parameters)
+        # Wait for the resampled volume
+        while cliParameterNode.IsBusy():
+            slicer.app.processEvents(qt.QEventLoop.ExcludeUserInputEvents)
+            time.sleep(0.01)
+        resamplingFailed = cliParameterNode.GetStatus() & cliParameterNode.ErrorsMask
+        errorText = cliParameterNode.GetErrorText()
         slicer.mrmlScene.RemoveNode(cliParameterNode)
+        if resamplingFailed:
+            raise ValueError("Resampling failed: " + errorText)
         
         # Set window / level of inputVolume in resampledVolume 
         displayNode = self.resampledVolume.GetDisplayNode()
         displayNode.AutoWindowLevelOff()
         displayNode.SetWindowLevel(1400, -500)
 
-        if not self.outputSegmentation:
-            self.outputSegmentation = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "Lung segmentation")
-            self.outputSegmentation.CreateDefaultDisplayNodes()
-        # We show the current segmentation using markups, so let's hide the display node (seeds)
-        self.rightLungSegmentId = None
-        self.leftLungSegmentId = None
-        self.tracheaSegmentId = None
-        self.outputSegmentation.GetDisplayNode().SetVisibility(False)
         self.outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(self.resampledVolume)
-
-        # Create temporary segment editor to get access to effects
-        self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        self.segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        self.segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-        self.segmentEditorWidget.setMRMLSegmentEditorNode(self.segmentEditorNode)
-        self.segmentEditorWidget.setSegmentationNode(self.outputSegmentation)
         self.segmentEditorWidget.setSourceVolumeNode(self.resampledVolume)
 
 
@@ -1561,20 +1813,36 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         logging.info('StartSegmentation completed in {0:.2f} seconds'.format(stopTime-startTime))
         
     def updateSeedSegmentFromMarkups(self, segmentName, markupsNode, color, radius, segmentId):
+        seedPoints = vtk.vtkPoints()
+        markupsNode.GetControlPointPositionsWorld(seedPoints)
+        seedPositions = (radius, tuple(seedPoints.GetPoint(i) for i in range(seedPoints.GetNumberOfPoints())))
+        segmentation = self.outputSegmentation.GetSegmentation()
+        segmentIndex = -1
         if segmentId:
-            self.outputSegmentation.GetSegmentation().RemoveSegment(segmentId)
-        append = vtk.vtkAppendPolyData()
-        numFids = markupsNode.GetNumberOfControlPoints()
-        for i in range(numFids):
-            ras = [0,0,0]
-            markupsNode.GetNthControlPointPosition(i,ras)
-            sphere = vtk.vtkSphereSource()
-            sphere.SetCenter(ras)
-            sphere.SetRadius(radius)
-            sphere.Update()
-            append.AddInputData(sphere.GetOutput())
-        append.Update()
-        return self.outputSegmentation.AddSegmentFromClosedSurfaceRepresentation(append.GetOutput(), segmentName, color)
+            if self._seedPositions.get(segmentId) == seedPositions and segmentation.GetSegment(segmentId):
+                # Seeds have not moved, keep the current seed segment
+                return segmentId
+            segmentIndex = segmentation.GetSegmentIndex(segmentId)
+            segmentation.RemoveSegment(segmentId)
+            self._seedPositions.pop(segmentId, None)
+        self._seedsModified = True
+        # Place one sphere glyph at each control point (single pipeline execution)
+        seedPolyData = vtk.vtkPolyData()
+        seedPolyData.SetPoints(seedPoints)
+        sphere = vtk.vtkSphereSource()
+        sphere.SetRadius(radius)
+        glyph = vtk.vtkGlyph3D()
+        glyph.SetInputData(seedPolyData)
+        glyph.SetSourceConnection(sphere.GetOutputPort())
+        glyph.ScalingOff()
+        glyph.OrientOff()
+        glyph.Update()
+        segmentId = self.outputSegmentation.AddSegmentFromClosedSurfaceRepresentation(glyph.GetOutput(), segmentName, color)
+        if segmentIndex >= 0:
+            # keep segment order (right lung, left lung, other) when only some seeds are rebuilt
+            segmentation.SetSegmentIndex(segmentId, segmentIndex)
+        self._seedPositions[segmentId] = seedPositions
+        return segmentId
 
     def updateSegmentation(self):
       """
@@ -1584,30 +1852,44 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
       if self.useAI: 
         return
 
-      if (not self.rightLungFiducials or self.rightLungFiducials.GetNumberOfControlPoints() < 6
-          or not self.leftLungFiducials or self.leftLungFiducials.GetNumberOfControlPoints() < 6
-          or not self.tracheaFiducials or self.tracheaFiducials.GetNumberOfControlPoints() < 1):
+      rightLungFiducials = self.rightLungFiducials
+      leftLungFiducials = self.leftLungFiducials
+      tracheaFiducials = self.tracheaFiducials
+      if (not rightLungFiducials or rightLungFiducials.GetNumberOfControlPoints() < 6
+          or not leftLungFiducials or leftLungFiducials.GetNumberOfControlPoints() < 6
+          or not tracheaFiducials or tracheaFiducials.GetNumberOfControlPoints() < 1):
           # not yet ready for region growing
           return
 
       self.showStatusMessage('Update segmentation...')
-      self.rightLungSegmentId = self.updateSeedSegmentFromMarkups("right lung", self.rightLungFiducials, self.rightLungColor, 10.0, self.rightLungSegmentId)
-      self.leftLungSegmentId = self.updateSeedSegmentFromMarkups("left lung", self.leftLungFiducials, self.leftLungColor, 10.0, self.leftLungSegmentId)
-      self.tracheaSegmentId = self.updateSeedSegmentFromMarkups("other", self.tracheaFiducials, self.unknownColor, 2.0, self.tracheaSegmentId)
+      self.rightLungSegmentId = self.updateSeedSegmentFromMarkups("right lung", rightLungFiducials, self.rightLungColor, 10.0, self.rightLungSegmentId)
+      self.leftLungSegmentId = self.updateSeedSegmentFromMarkups("left lung", leftLungFiducials, self.leftLungColor, 10.0, self.leftLungSegmentId)
+      self.tracheaSegmentId = self.updateSeedSegmentFromMarkups("other", tracheaFiducials, self.unknownColor, 2.0, self.tracheaSegmentId)
+
+      intensityRange = [self.lungThresholdMin, self.lungThresholdMax]
+      activeEffect = self.segmentEditorWidget.activeEffect()
+      if (not self._seedsModified and intensityRange == self._previewIntensityRange
+          and activeEffect and activeEffect.name == "Grow from seeds"):
+          # Neither seeds nor thresholds changed since the last preview
+          return
 
       # Activate region growing segmentation
       self.showStatusMessage('Region growing...')
 
       # Set intensity mask and thresholds again to reflect their possible changes and update button
-      self.segmentEditorWidget.mrmlSegmentEditorNode().SetMasterVolumeIntensityMask(True)
-      intensityRange = [self.lungThresholdMin, self.lungThresholdMax]
-      self.segmentEditorWidget.mrmlSegmentEditorNode().SetSourceVolumeIntensityMaskRange(intensityRange)
+      segmentEditorNode = self.segmentEditorWidget.mrmlSegmentEditorNode()
+      if not segmentEditorNode.GetMasterVolumeIntensityMask():
+          segmentEditorNode.SetMasterVolumeIntensityMask(True)
+      if list(segmentEditorNode.GetSourceVolumeIntensityMaskRange()) != intensityRange:
+          segmentEditorNode.SetSourceVolumeIntensityMaskRange(intensityRange)
       # set effect
       self.segmentEditorWidget.setActiveEffectByName("Grow from seeds")
       effect = self.segmentEditorWidget.activeEffect()
       # extent farther from control points than usual to capture lung edges
       effect.self().extentGrowthRatio = 0.5
       effect.self().onPreview()
+      self._seedsModified = False
+      self._previewIntensityRange = intensityRange
       #effect.self().setPreviewOpacity(0.5)
       effect.self().setPreviewShow3D(True)
       # center 3D view
@@ -1618,18 +1900,34 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
     def removeTemporaryObjects(self):
         if self.resampledVolume:
+            # the node reference is cleared when the node is removed
             slicer.mrmlScene.RemoveNode(self.resampledVolume)
-        if self.segmentEditorWidget:
+        if self.segmentEditorWidget and self.segmentEditorWidget.mrmlSegmentEditorNode():
             self.segmentEditorNode = self.segmentEditorWidget.mrmlSegmentEditorNode()
             # Cancel "Grow from seeds" (deletes preview segmentation)
             self.segmentEditorWidget.setActiveEffectByName("Grow from seeds")
             effect = self.segmentEditorWidget.activeEffect()
             if effect:
                 effect.self().reset()
-            # Deactivates all effects
+            # Deactivates all effects, the widget itself is kept for the next run
             self.segmentEditorWidget.setActiveEffect(None)
-            self.segmentEditorWidget = None
-            slicer.mrmlScene.RemoveNode(self.segmentEditorNode)
+            self.segmentEditorWidget.setMRMLSegmentEditorNode(None)
+            if self.segmentEditorNode.GetScene():
+                slicer.mrmlScene.RemoveNode(self.segmentEditorNode)
+            self.segmentEditorNode = None
+
+    def runFullPipeline(self):
+        """
+        Run start, update and apply segmentation in one go, e.g. for testing or batch processing.
+        Rendering is paused for the whole run so that the views are only repainted at the end.
+        """
+        slicer.app.pauseRender()
+        try:
+            self.startSegmentation()
+            self.updateSegmentation()
+            self.applySegmentation()
+        finally:
+            slicer.app.resumeRender()
 
     def cancelSegmentation(self):
         if self.outputSegmentation:
@@ -1649,41 +1947,113 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             slicer.mrmlScene.RemoveNode(self.tsOutputExtendedSegmentation)
         if self.maskedVolume: 
             slicer.mrmlScene.RemoveNode(self.maskedVolume)
-        
-        self.removeTemporaryObjects()
 
         self.segmentationStarted = False
 
     def showStatusMessage(self, msg, timeoutMsec=500):
         slicer.util.showStatusMessage(msg, timeoutMsec)
-        slicer.app.processEvents()
-
-    def trimSegmentWithCube(self, id,r,a,s,offs_r,offs_a,offs_s) :
-          
-        self.segmentEditorNode.SetSelectedSegmentID(id)
-        self.segmentEditorWidget.setActiveEffectByName("Surface cut")
+        # Process events at most every 100 ms, status messages often come in quick succession
+        now = time.monotonic()
+        if now - self._lastProcessEventsTime > 0.1:
+            slicer.app.processEvents()
+            self._lastProcessEventsTime = now
 
-        effect = self.segmentEditorWidget.activeEffect()
-
-        effect.self().fiducialPlacementToggle.placeButton().click()
-        
-            
-        # trim with cube
+    def getSegmentMask(self, segmentationNode, segmentId, referenceVolumeNode):
+        """
+        Return the binary labelmap array (kji) of a segment in the reference volume geometry
+        and the IJK to RAS matrix of the reference volume as a NumPy array.
+        """
+        mask = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentId, referenceVolumeNode)
+        ijkToRasMatrix = vtk.vtkMatrix4x4()
+        referenceVolumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+        return mask, slicer.util.arrayFromVTKMatrix(ijkToRasMatrix)
 
-        points =[[r-offs_r, a+offs_a, s+offs_s], [r+offs_r, a+offs_a, s+offs_s],
-                 [r+offs_r, a+offs_a, s-offs_s], [r-offs_r, a+offs_a, s-offs_s],
-                 [r-offs_r, a-offs_a, s+offs_s], [r+offs_r, a-offs_a, s+offs_s],
-                 [r+offs_r, a-offs_a, s-offs_s], [r-offs_r, a-offs_a, s-offs_s],
-                ]
+    def iterateMaskSlicePositions(self, mask, ijkToRas):
+        """
+        Yield the RAS positions (N x 3) of the nonzero voxels of mask, one k slice at a time,
+        so that position arrays are never allocated for the whole segment.
+        """
+        for k in np.flatnonzero(mask.any(axis=(1, 2))):
+            j, i = np.nonzero(mask[k])
+            ijk = np.column_stack((i, j, np.full(i.shape, k))).astype(np.float64)
+            yield ijk @ ijkToRas[:3,:3].T + ijkToRas[:3,3]
 
-        for p in points:
-            effect.self().segmentMarkupNode.AddFiducialFromArray(p)
-        
-        effect.setParameter("Operation","ERASE_INSIDE")
-        effect.setParameter("SmoothModel","0")
+    def eraseBoxFromMask(self, mask, ijkToRas, center, halfSize):
+        """
+        Set the voxels of mask (kji) whose centers are inside the RAS axis aligned box
+        (center, halfSize in mm) to 0. Only the IJK bounding box of the RAS box is visited,
+        which is a plain slab assignment if the volume axes are aligned with RAS.
+        """
+        corners_ras = np.asarray(center) + np.asarray(halfSize) * np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)])
+        rasToIjk = np.linalg.inv(ijkToRas)
+        corners_ijk = corners_ras @ rasToIjk[:3,:3].T + rasToIjk[:3,3]
+        tolerance = 1e-6
+        lower = np.maximum(np.ceil(corners_ijk.min(axis=0) - tolerance).astype(int), 0)
+        upper = np.minimum(np.floor(corners_ijk.max(axis=0) + tolerance).astype(int) + 1, mask.shape[::-1])
+        if np.any(lower >= upper):
+            return
+        region = mask[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+        direction = ijkToRas[:3,:3]
+        if np.count_nonzero(np.abs(direction) > tolerance * np.abs(direction).max()) == 3:
+            # each IJK axis is parallel to one RAS axis, the IJK bounding box is the box itself
+            region[:] = 0
+            return
+        # oblique volume, test the voxel centers of the bounding box slice by slice
+        i = np.arange(lower[0], upper[0])
+        j = np.arange(lower[1], upper[1])
+        for regionSlice, k in zip(region, range(lower[2], upper[2])):
+            inside = np.ones(regionSlice.shape, dtype=bool)
+            for axis in range(3):
+                position = direction[axis,0] * i[np.newaxis,:] + direction[axis,1] * j[:,np.newaxis] + (direction[axis,2] * k + ijkToRas[axis,3])
+                inside &= np.abs(position - center[axis]) <= halfSize[axis]
+            regionSlice[inside] = 0
+
+    def trimSegmentWithCubes(self, id, mask, ijkToRas, cubes):
+        """
+        Set segment id to a copy of mask (in inputVolume geometry) with the voxels inside the axis aligned boxes erased.
+        cubes is a list of ((r,a,s) center, (offs_r,offs_a,offs_s) half size) in mm.
+        """
+        trimmedMask = mask.copy()
+        for center, halfSize in cubes:
+            self.eraseBoxFromMask(trimmedMask, ijkToRas, center, halfSize)
+        slicer.util.updateSegmentBinaryLabelmapFromArray(trimmedMask, self.outputSegmentation, id, self.inputVolume)
 
-        effect.self().onApply()
-        
+    def closeSegmentsOverwriteOthers(self, segmentIds, kernelSizeMm, referenceVolumeNode):
+        """
+        Morphological closing of the listed segments, one after the other, with SimpleITK.
+        Voxels added to a segment are removed from the other listed segments, the same
+        result as the Smoothing effect's closing with "overwrite all segments".
+        """
+        # Kernel size in voxels is rounded to the nearest odd number, exactly as in the Smoothing effect,
+        # the ball radius is the number of voxels on each side of the kernel center
+        spacing = referenceVolumeNode.GetSpacing()
+        kernelSizePixel = [int(round((kernelSizeMm / spacing[axis] + 1) / 2) * 2 - 1) for axis in range(3)]
+        radius = [(size - 1) // 2 for size in kernelSizePixel]
+        masks = {}
+        for segmentId in segmentIds:
+            masks[segmentId] = (slicer.util.arrayFromSegmentBinaryLabelmap(self.outputSegmentation, segmentId, referenceVolumeNode) > 0).view(np.uint8)
+        for i, segmentId in enumerate(segmentIds):
+            self.showStatusMessage(f'Filling holes ({i+1}/{len(segmentIds)})...')
+            # Closing cannot grow a segment beyond its bounding box, so only process the
+            # bounding box padded by the kernel radius (numpy kji axis order)
+            mask = masks[segmentId]
+            crop = []
+            for axis, otherAxes in enumerate([(1, 2), (0, 2), (0, 1)]):
+                nonzero = np.flatnonzero(mask.any(axis=otherAxes))
+                if nonzero.size == 0:
+                    break
+                pad = radius[2 - axis] + 1
+                crop.append(slice(max(nonzero[0] - pad, 0), min(nonzero[-1] + pad + 1, mask.shape[axis])))
+            else:
+                crop = tuple(crop)
+                closedImage = sitk.BinaryMorphologicalClosing(sitk.GetImageFromArray(np.ascontiguousarray(mask[crop])), radius, sitk.sitkBall)
+                closed = sitk.GetArrayFromImage(closedImage).astype(bool)
+                mask[crop] = closed
+                for otherSegmentId in segmentIds:
+                    if otherSegmentId != segmentId:
+                        masks[otherSegmentId][crop][closed] = 0
+        for segmentId in segmentIds:
+            slicer.util.updateSegmentBinaryLabelmapFromArray(masks[segmentId], self.outputSegmentation, segmentId, referenceVolumeNode)
 
     def createSubSegment(self,segmentId,name): 
         segmentName = self.outputSegmentation.GetSegmentation().GetSegment(segmentId).GetName()
@@ -1701,168 +2071,80 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         return newSeg
 
 
+    def computeCentroidAndObbDiameters(self, mask, ijkToRas):
+        """
+        Compute centroid (RAS) and oriented bounding box diameters (mm) of a segment
+        from its binary labelmap, one slice at a time. Diameters are ordered by principal axis
+        variance, smallest first (same order as SegmentStatistics obb_diameter_mm).
+        """
+        # first pass: centroid and covariance from the sums of positions and their outer products
+        numberOfVoxels = 0
+        sum_ras = np.zeros(3)
+        sumOfOuterProducts_ras = np.zeros((3, 3))
+        for points_ras in self.iterateMaskSlicePositions(mask, ijkToRas):
+            numberOfVoxels += len(points_ras)
+            sum_ras += points_ras.sum(axis=0)
+            sumOfOuterProducts_ras += points_ras.T @ points_ras
+        centroid_ras = sum_ras / numberOfVoxels
+        covariance = (sumOfOuterProducts_ras - numberOfVoxels * np.outer(centroid_ras, centroid_ras)) / (numberOfVoxels - 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        # second pass: extent of the voxels along the principal axes
+        projectionMin = np.full(3, np.inf)
+        projectionMax = np.full(3, -np.inf)
+        for points_ras in self.iterateMaskSlicePositions(mask, ijkToRas):
+            projections = (points_ras - centroid_ras) @ eigenvectors
+            projectionMin = np.minimum(projectionMin, projections.min(axis=0))
+            projectionMax = np.maximum(projectionMax, projections.max(axis=0))
+        # add the extent of one voxel along each principal axis
+        voxelExtent = np.abs(ijkToRas[:3,:3].T @ eigenvectors).sum(axis=0)
+        obb_diameter_mm = projectionMax - projectionMin + voxelExtent
+        return centroid_ras, obb_diameter_mm
+
     def createDetailedMasks(self): 
         segmentationNode = self.outputSegmentation
-        
-        import SegmentStatistics
-
-        # Compute centroids
-        self.showStatusMessage('Computing centroids ...')
-        segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-        segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.centroid_ras.enabled", str(True))
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_origin_ras.enabled",str(True))
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_diameter_mm.enabled",str(True))
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_x.enabled",str(True))
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_y.enabled",str(True))
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_z.enabled",str(True))
-        segStatLogic.computeStatistics()
-        stats = segStatLogic.getStatistics()
+
+        # Boxes erased from each sub-segment copy of a lung, as (center offset, half size)
+        # in units of the lung OBB diameters (axial, sagittal, coronal) relative to the centroid.
+        # Sub-segments are created in this order.
+        subSegmentCropBoxes = [
+            ("anterior", [((0., -1/2., 0.), (1., 1/2., 1.))]),
+            ("posterior", [((0., 1/2., 0.), (1., 1/2., 1.))]),
+            ("upper", [((0., 0., -1/2.), (1., 1., 2/3.))]),
+            ("middle", [((0., 0., 1/2.), (1., 1., 1/3.)), ((0., 0., -1/2.), (1., 1., 1/3.))]),
+            ("lower", [((0., 0., 1/2.), (1., 1., 2/3.))]),
+            ("upperhalf", [((0., 0., -1/2.), (1., 1., 1/2.))]),
+            ("lowerhalf", [((0., 0., 1/2.), (1., 1., 1/2.))]),
+            ]
 
         # Place a markup point in each centroid
         markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
         markupsNode.CreateDefaultDisplayNodes()
-        for segmentId in stats['SegmentIDs']:
-            if segmentId == self.rightLungSegmentId or segmentId == self.leftLungSegmentId:
-
-                # get centroid
-                centroid_ras = stats[segmentId,"LabelmapSegmentStatisticsPlugin.centroid_ras"]
-                # get bounding box
-                import numpy as np
-                obb_origin_ras = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_origin_ras"])
-                obb_diameter_mm = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_diameter_mm"])
-                obb_direction_ras_x = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_x"])
-                obb_direction_ras_y = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_y"])
-                obb_direction_ras_z = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_z"])
-                obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2] * obb_direction_ras_z)
-                axialLungDiameter = obb_diameter_mm[0]
-                sagittalLungDiameter = obb_diameter_mm[1]
-                coronalLungDiameter = obb_diameter_mm[2]
-                coronalApex = centroid_ras[2] + (coronalLungDiameter/2.)
+        for segmentId in [self.rightLungSegmentId, self.leftLungSegmentId]:
+            if segmentId:
+
+                # get centroid and oriented bounding box, the lung mask is reused for all sub-segments
+                self.showStatusMessage('Computing centroids ...')
+                mask, ijkToRas = self.getSegmentMask(segmentationNode, segmentId, self.inputVolume)
+                centroid_ras, obb_diameter_mm = self.computeCentroidAndObbDiameters(mask, ijkToRas)
                                 
                 segmentName = segmentationNode.GetSegmentation().GetSegment(segmentId).GetName()
                 markupsNode.AddFiducialFromArray(centroid_ras, segmentName)
                 
                 self.showStatusMessage('Creating special masks ...')
-                anterior = self.createSubSegment(segmentId, "anterior")
-                posterior = self.createSubSegment(segmentId, "posterior")
-                upper = self.createSubSegment(segmentId, "upper")
-                middle = self.createSubSegment(segmentId, "middle")
-                lower = self.createSubSegment(segmentId, "lower")
-                upperhalf = self.createSubSegment(segmentId, "upperhalf")
-                lowerhalf = self.createSubSegment(segmentId, "lowerhalf")
-                
-                ####### anterior
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] - (sagittalLungDiameter/2.)
-                s = centroid_ras[2]
-                
-                
-                crop_r = axialLungDiameter  
-                crop_a = (sagittalLungDiameter/2.)
-                crop_s = coronalLungDiameter
-                
-                self.showStatusMessage(' Cropping anterior mask ...')
-                self.trimSegmentWithCube(anterior.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-                ####### posterior
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] + (sagittalLungDiameter/2.)
-                s = centroid_ras[2]
-                
-                crop_r = axialLungDiameter
-                crop_a = (sagittalLungDiameter/2.)
-                crop_s = coronalLungDiameter
-
-                self.showStatusMessage(' Cropping posterior mask ...')
-                self.trimSegmentWithCube(posterior.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-                ####### upper half
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] 
-                s = centroid_ras[2] - (coronalLungDiameter/2.)
-                
-                crop_r = axialLungDiameter
-                crop_a = sagittalLungDiameter
-                crop_s = coronalLungDiameter/2.
-
-                self.showStatusMessage(' Cropping upper half  mask ...')
-                self.trimSegmentWithCube(upperhalf.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-                ####### lower half
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] 
-                s = centroid_ras[2] + (coronalLungDiameter/2.)
-                
-                crop_r = axialLungDiameter
-                crop_a = sagittalLungDiameter
-                crop_s = coronalLungDiameter/2.
-
-                self.showStatusMessage(' Cropping lower half  mask ...')
-                self.trimSegmentWithCube(lowerhalf.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-                ####### upper
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] 
-                s = coronalApex - coronalLungDiameter
-                
-                crop_r = axialLungDiameter
-                crop_a = sagittalLungDiameter
-                crop_s = (coronalLungDiameter/3.) * 2.
-
-                self.showStatusMessage(' Cropping upper mask ...')
-                self.trimSegmentWithCube(upper.GetName(),r,a,s,crop_r,crop_a,crop_s)
-           
-                ####### middle
-                
-                ####### crop upper part
-                r = centroid_ras[0]
-                a = centroid_ras[1] 
-                s = coronalApex
-
-                
-                crop_r = axialLungDiameter 
-                crop_a = sagittalLungDiameter
-                crop_s = (coronalLungDiameter/3.)
-
-                self.showStatusMessage(' Cropping middle mask ...')
-                self.trimSegmentWithCube(middle.GetName(),r,a,s,crop_r,crop_a,crop_s)
-
-                ####### crop lower part
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] 
-                s = coronalApex - coronalLungDiameter 
-
-                crop_r = axialLungDiameter  
-                crop_a = sagittalLungDiameter
-                crop_s = (coronalLungDiameter/3.)
-
-                self.trimSegmentWithCube(middle.GetName(),r,a,s,crop_r,crop_a,crop_s)
+                subSegments = [(self.createSubSegment(segmentId, name), cropBoxes) for name, cropBoxes in subSegmentCropBoxes]
 
-                ####### lower
-                
-                r = centroid_ras[0]
-                a = centroid_ras[1] 
-                s = coronalApex
-
-                
-                crop_r = axialLungDiameter  
-                crop_a = sagittalLungDiameter
-                crop_s = (coronalLungDiameter/3.)*2.
-
-                self.showStatusMessage(' Cropping lower mask ...')
-                self.trimSegmentWithCube(lower.GetName(),r,a,s,crop_r,crop_a,crop_s)
+                for subSegment, cropBoxes in subSegments:
+                    self.showStatusMessage(f' Cropping {subSegment.GetName()} mask ...')
+                    cubes = [(centroid_ras + np.multiply(centerOffset, obb_diameter_mm), np.multiply(halfSize, obb_diameter_mm))
+                        for centerOffset, halfSize in cropBoxes]
+                    self.trimSegmentWithCubes(subSegment.GetName(), mask, ijkToRas, cubes)
+                del mask
 
 
     def postprocessSegment(self, outputSegmentation, _nth, segmentName):
-        outputSegmentation.GetSegmentation().GetNthSegment(_nth).SetName(segmentName)
-        _segID = outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
+        segmentation = outputSegmentation.GetSegmentation()
+        _segID = segmentation.GetNthSegmentID(_nth)
+        segmentation.GetSegment(_segID).SetName(segmentName)
         
         if self.useAI and self.smoothLungs:
             self.segmentEditorWidget.setSegmentationNode(outputSegmentation)
@@ -1881,23 +2163,51 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         displayNode.SetOpacity3D(1.0)  
         # Set opacity of a single segment
         displayNode.SetSegmentOpacity3D(_segID, 0.3)  
-        self.setAnatomicalTag(self.outputSegmentation, segmentName, _segID)
+        self.setAnatomicalTag(outputSegmentation, segmentName, _segID)
         
 
 
-    def addSegmentFromNumpyArray(self, outputSegmentation, input_np, segmentName, labelValue, inputVolume, color):
+    def addSegmentFromNumpyArray(self, outputSegmentation, input_np, segmentName, labelValue, inputVolume, color, maskBuffer=None):
+        """
+        Add voxels of input_np equal to labelValue as a new segment.
+        Optional maskBuffer (bool array of input_np shape) is reused for the mask instead of allocating one.
+        """
         emptySegment = slicer.vtkSegment()
         emptySegment.SetName(segmentName)
         emptySegment.SetColor(color)
-        outputSegmentation.GetSegmentation().AddSegment(emptySegment)
+        segmentId = outputSegmentation.GetSegmentation().AddSegment(emptySegment)
 
-        import numpy as np
-        segment_np = np.zeros(input_np.shape)
-        segment_np[ input_np==labelValue ] = 1
+        # single pass, 1 byte per voxel
+        segment_np = np.equal(input_np, labelValue, out=maskBuffer).view(np.uint8)
 
-        segmentId = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
         slicer.util.updateSegmentBinaryLabelmapFromArray(segment_np, outputSegmentation, segmentId, inputVolume)
 
+    def addSegmentsFromNumpyArray(self, outputSegmentation, input_np, segments, inputVolume):
+        """
+        Add one segment for each (segmentName, labelValue, color) item of segments.
+        The label volume is imported once, all segments are filled from that single pass.
+        """
+        segmentation = outputSegmentation.GetSegmentation()
+        # label value N is imported into the Nth segment ID
+        segmentIdsByLabel = [""] * max(labelValue for _, labelValue, _ in segments)
+        for segmentName, labelValue, color in segments:
+            emptySegment = slicer.vtkSegment()
+            emptySegment.SetName(segmentName)
+            emptySegment.SetColor(color)
+            segmentIdsByLabel[labelValue - 1] = segmentation.AddSegment(emptySegment)
+        updatedSegmentIds = vtk.vtkStringArray()
+        for segmentId in segmentIdsByLabel:
+            updatedSegmentIds.InsertNextValue(segmentId)
+
+        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+        try:
+            slicer.util.updateVolumeFromArray(labelmapVolumeNode, input_np)
+            ijkToRas = vtk.vtkMatrix4x4()
+            inputVolume.GetIJKToRASMatrix(ijkToRas)
+            labelmapVolumeNode.SetIJKToRASMatrix(ijkToRas)
+            slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, outputSegmentation, updatedSegmentIds)
+        finally:
+            slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
 
     def normalize_ct_scan(self, ct_scan, air_hu=-1000, muscle_hu=30):
         """
@@ -1910,7 +2220,6 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         Returns:
             ndarray: A normalized version of the CT scan.
         """
-        import numpy as np
         
         # Store the data type of the input array
         _dtype = ct_scan.dtype
@@ -1925,11 +2234,14 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
         # print("normalize_ct_scan: slope " + str(slope) + " intercept " + str(intercept) + " min_hu " + str(min_hu) + " max_hu " + str(max_hu))
 
-        # Apply the normalization
-        normalized_ct_scan = (ct_scan * slope) + intercept
+        # Apply the normalization in place on a single float working copy
+        # (float32 is exact for 16-bit CT data)
+        normalized_ct_scan = ct_scan.astype(np.promote_types(_dtype, np.float32))
+        normalized_ct_scan *= slope
+        normalized_ct_scan += intercept
 
-        # Convert the data type of the generated standardized_array (float) into a new array with the type of the input array before returning it
-        array = normalized_ct_scan.astype(_dtype)
+        # Convert the data type of the generated standardized_array (float) into the type of the input array before returning it
+        array = normalized_ct_scan.astype(_dtype, copy=False)
 
         return array
 
@@ -1961,11 +2273,14 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
 
         # print("calibrate_ct_scan: slope " + str(self.slope) + " intercept " + str(self.intercept) + " d " + str(d) + " air_mean_hu " + str(air_mean_hu) + " muscle_mean_hu " + str(muscle_mean_hu))
 
-        # Adjust the CT
-        a2 = ct_pixel_array * self.slope + self.intercept
+        # Adjust the CT in place on a single float working copy
+        # (float32 is exact for 16-bit CT data)
+        a2 = ct_pixel_array.astype(np.promote_types(_dtype, np.float32))
+        a2 *= self.slope
+        a2 += self.intercept
 
-        # Convert the data type of the generated standardized_array (float) into a new array with the type of the input array before returning it
-        a3 = a2.astype(_dtype)
+        # Convert the data type of the generated standardized_array (float) into the type of the input array before returning it
+        a3 = a2.astype(_dtype, copy=False)
 
         return a3
 
@@ -2011,79 +2326,10 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         return os.path.dirname(os.path.realpath(sys.argv[0]))
 
     def setAnatomicalTag(self, _outputsegmentation, _name, _segID):
-        segment = _outputsegmentation.GetSegmentation().GetSegment(_segID)
-        if _name == "right lung": 
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^39607008^Lung"
-                "~SCT^24028007^Right"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "left lung":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^39607008^Lung"
-                "~SCT^7771000^Left"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "left upper lobe":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^45653009^Upper lobe of Lung"
-                "~SCT^7771000^Left"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "left lower lobe":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^90572001^Lower lobe of lung"
-                "~SCT^7771000^Left"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "right upper lobe":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^45653009^Upper lobe of lung"
-                "~SCT^24028007^Right"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "right middle lobe":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^72481006^Middle lobe of right lung"
-                "~^^"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "right lower lobe":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-                "Segmentation category and type - 3D Slicer General Anatomy list"
-                "~SCT^123037004^Anatomical Structure"
-                "~SCT^90572001^Lower lobe of lung"
-                "~SCT^24028007^Right"
-                "~Anatomic codes - DICOM master list"
-                "~^^"
-                "~^^")
-        elif _name == "airways":
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-              "Segmentation category and type - 3D Slicer General Anatomy list"
-              "~SCT^123037004^Anatomical Structure"
-              "~SCT^44567001^Trachea"
-              "~^^"
-              "~Anatomic codes - DICOM master list"
-              "~^^"
-              "~^^")
+        terminologyEntry = ANATOMICAL_TERMINOLOGY.get(_name)
+        if terminologyEntry:
+            segment = _outputsegmentation.GetSegmentation().GetSegment(_segID)
+            segment.SetTag(segment.GetTerminologyEntryTagName(), terminologyEntry)
         #else:
         #    print(_name + " not handled during SetTag.")
         
@@ -2094,6 +2340,9 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         sourceSegmentId = _inputsegmentation.GetSegmentation().GetSegmentIdBySegmentName(_inputName)
         if sourceSegmentId:
             _outputsegmentation.GetSegmentation().CopySegmentFromSegmentation(_inputsegmentation.GetSegmentation(), sourceSegmentId)
+            # Do not carry over the closed surface from TotalSegmentator, it would be regenerated after every
+            # edit (smoothing) below; surfaces are created once at the end of applySegmentation if needed
+            _outputsegmentation.RemoveClosedSurfaceRepresentation()
             _segID = _outputsegmentation.GetSegmentation().GetSegmentIdBySegmentName(_inputName)
             _outputsegmentation.GetDisplayNode().SetSegmentVisibility(_segID,_visibility)
             _outputsegmentation.GetSegmentation().GetSegment(_segID).SetName(_outputName)
@@ -2102,7 +2351,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             displayNode = _outputsegmentation.GetDisplayNode()
             # Set overall opacity of the segmentation
             displayNode.SetOpacity3D(1.0)  
-            if (_outputName.find("lobe") > -1 or _outputName.find("lung") > -1) and self.smoothLungs:
+            if _outputName in SMOOTHED_TOTALSEGMENTATOR_SEGMENTS and self.smoothLungs:
                 # smooth segment
                 self.segmentEditorWidget.setSegmentationNode(_outputsegmentation)
                 self.segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone) 
@@ -2118,10 +2367,47 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 # Set opacity of a single segment
                 displayNode.SetSegmentOpacity3D(_segID, 0.3)  
 
-    def saveVolTemp(self, inputVolume):
-        import time
-        import tempfile
+    def getLungmaskCacheFilePath(self, inputVolumeSitk, modelKey):
+        """
+        Return the cache file path for a lungmask result. The file name is a hash
+        of the model key and the input image geometry and voxels.
+        """
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(modelKey.encode())
+        hasher.update(repr((inputVolumeSitk.GetPixelIDValue(), inputVolumeSitk.GetSize(), inputVolumeSitk.GetSpacing(),
+          inputVolumeSitk.GetOrigin(), inputVolumeSitk.GetDirection())).encode())
+        hasher.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(inputVolumeSitk)))
+        return os.path.join(slicer.app.temporaryPath, "LungCTSegmenter", "lungmask_cache", hasher.hexdigest() + ".npz")
+
+    def loadLungmaskCache(self, cacheFilePath):
+        """
+        Return the cached lungmask label array or None if there is no usable cache entry.
+        """
+        if not os.path.isfile(cacheFilePath):
+            return None
+        try:
+            with np.load(cacheFilePath) as cached:
+                return cached["labels"]
+        except Exception:
+            logging.warning(f"Ignoring unreadable lungmask cache file {cacheFilePath}")
+            return None
+
+    def saveLungmaskCache(self, cacheFilePath, segmentation_np, maximumNumberOfCachedResults=5):
+        """
+        Store a lungmask label array in the cache, keeping only the most recent results.
+        """
+        cacheDir = os.path.dirname(cacheFilePath)
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            np.savez_compressed(cacheFilePath, labels=segmentation_np)
+            cachedFiles = sorted((entry for entry in os.scandir(cacheDir) if entry.name.endswith(".npz")),
+              key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in cachedFiles[maximumNumberOfCachedResults:]:
+                os.remove(entry.path)
+        except OSError:
+            logging.warning(f"Could not write lungmask cache file {cacheFilePath}")
 
+    def saveVolTemp(self, inputVolume):
         # Temporary folder path
         tempVolDir = slicer.app.temporaryPath + "/LungCTSegmenter/"
         # Select the volume node you are trying to work with
@@ -2129,9 +2415,9 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
         image_id = volNode.GetName()
         # Absolute path of the temporary volume file
         in_file = tempfile.NamedTemporaryFile(suffix= '.nrrd', dir = tempVolDir).name
-        # save the volume node
+        # save the volume node (uncompressed, the file is only read once by the local server)
         start = time.time()
-        slicer.util.saveNode(volNode, in_file)
+        slicer.util.saveNode(volNode, in_file, {"useCompression": 0})
         logging.info(f"Saved Input Node into {in_file} in {time.time() - start:3.1f}s")
         return tempVolDir, image_id, in_file
 
@@ -2209,7 +2495,6 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             # no region growing was done
             return
 
-        import time
         startTime = time.time()
 
         # use it
@@ -2238,14 +2523,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             segmentIds = [self.rightLungSegmentId, self.leftLungSegmentId, self.tracheaSegmentId]
             
             # fill holes
-            for i, segmentId in enumerate(segmentIds):
-                self.showStatusMessage(f'Filling holes ({i+1}/{len(segmentIds)})...')
-                self.segmentEditorNode.SetSelectedSegmentID(segmentId)
-                self.segmentEditorWidget.setActiveEffectByName("Smoothing")
-                effect = self.segmentEditorWidget.activeEffect()
-                effect.setParameter("SmoothingMethod","MORPHOLOGICAL_CLOSING")
-                effect.setParameter("KernelSizeMm","12")
-                effect.self().onApply()
+            self.closeSegmentsOverwriteOthers(segmentIds, 12.0, self.resampledVolume)
 
             # switch to full-resolution segmentation (this is quick, there is no need for progress message)
             self.outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(self.inputVolume)
@@ -2257,34 +2535,57 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 currentSegment = self.outputSegmentation.GetSegmentation().GetSegment(segmentId)
                 # Get master labelmap from segment
                 currentLabelmap = currentSegment.GetRepresentation("Binary labelmap")
+                # Skip labelmaps that already have the reference geometry (e.g., shared with a segment resampled before)
+                if (slicer.vtkOrientedImageDataResample.DoGeometriesMatch(currentLabelmap, referenceGeometryImageData)
+                  and slicer.vtkOrientedImageDataResample.DoExtentsMatch(currentLabelmap, referenceGeometryImageData)):
+                  continue
                 # Resample
                 if not slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
                   currentLabelmap, referenceGeometryImageData, currentLabelmap, False, True):
-                  raise ValueError("Failed to resample segment " << currentSegment.GetName())
+                  raise ValueError("Failed to resample segment " + currentSegment.GetName())
             self.segmentEditorWidget.setSourceVolumeNode(self.inputVolume)
             # Trigger display update
             self.outputSegmentation.Modified()
             self.outputSegmentation.EndModify(wasModified)
 
-            # smoothing
-            for i, segmentId in enumerate(segmentIds):
-                self.showStatusMessage(f'Smoothing ({i+1}/{len(segmentIds)})...')
-                self.segmentEditorNode.SetSelectedSegmentID(segmentId)
+            # Smoothing and shrinking are applied to all visible segments in a single effect call,
+            # so make sure that exactly the lung and airway seed segments are visible
+            displayNode = self.outputSegmentation.GetDisplayNode()
+            segmentation = self.outputSegmentation.GetSegmentation()
+            previousSegmentVisibility = {}
+            with batchedModify(displayNode):
+                for segmentIndex in range(segmentation.GetNumberOfSegments()):
+                    segmentId = segmentation.GetNthSegmentID(segmentIndex)
+                    previousSegmentVisibility[segmentId] = displayNode.GetSegmentVisibility(segmentId)
+                    displayNode.SetSegmentVisibility(segmentId, segmentId in segmentIds)
+            self.segmentEditorNode.SetSelectedSegmentID(segmentIds[0])
+
+            try:
+                # smoothing
+                self.showStatusMessage('Smoothing...')
                 self.segmentEditorWidget.setActiveEffectByName("Smoothing")
                 effect = self.segmentEditorWidget.activeEffect()
                 effect.setParameter("SmoothingMethod","GAUSSIAN")
                 effect.setParameter("GaussianStandardDeviationMm","2")
+                effect.setParameter("ApplyToAllVisibleSegments","1")
                 effect.self().onApply()
-            
-            if self.shrinkMasks: 
-                # Final shrinking masks by 1 mm
-                for i, segmentId in enumerate(segmentIds):
-                    self.showStatusMessage(f'Final shrinking ({i+1}/{len(segmentIds)})...')
-                    self.segmentEditorNode.SetSelectedSegmentID(segmentId)
+                
+                if self.shrinkMasks: 
+                    # Final shrinking masks by 1 mm
+                    self.showStatusMessage('Final shrinking...')
                     self.segmentEditorWidget.setActiveEffectByName("Margin")
                     effect = self.segmentEditorWidget.activeEffect()
                     effect.setParameter("MarginSizeMm","-1")
+                    effect.setParameter("ApplyToAllVisibleSegments","1")
                     effect.self().onApply()
+            finally:
+                # The parameters are stored in the segment editor node, reset them so that later
+                # single segment operations are not applied to all visible segments
+                for effectName in ["Smoothing", "Margin"]:
+                    self.segmentEditorWidget.effectByName(effectName).setParameter("ApplyToAllVisibleSegments","0")
+                with batchedModify(displayNode):
+                    for segmentId, visible in previousSegmentVisibility.items():
+                        displayNode.SetSegmentVisibility(segmentId, visible)
             
             if self.detailedMasks: 
                 self.createDetailedMasks()
@@ -2336,7 +2637,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             # Trigger display update
             self.outputSegmentation.Modified()
             self.outputSegmentation.EndModify(wasModified)           
-            if self.engineAI.find("lungmask") == 0:
+            if self.engineAI.startswith("lungmask"):
                 self.increment_counter('counter_lm')
                 if self.updateAI:
                     if slicer.util.confirmYesNoDisplay("Updating lunkmask AI will restart 3D Slicer. Are you sure?"):
@@ -2370,96 +2671,90 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                     infer_mode = "mask"
                     from lungmask import mask
                                    
-                inputVolumeSitk = sitkUtils.PullVolumeFromSlicer(self.inputVolume)
-                if self.engineAI == "lungmask R231":
-                    self.showStatusMessage('Creating lungs with lungmask AI ...')
-                    if infer_mode == "mask": 
-                        model = mask.get_model('unet','R231')
-                        segmentation_np = mask.apply(inputVolumeSitk, model)
-                    else: 
-                        inferer = LMInferer()
-                        segmentation_np = inferer.apply(inputVolumeSitk)                   
-                    # add lung segments
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right lung", 1, self.inputVolume, self.rightLungColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "left lung", 2, self.inputVolume, self.leftLungColor)
-                    # Postprocess lungs 
-                    self.postprocessSegment(self.outputSegmentation,0,"right lung")
-                    self.postprocessSegment(self.outputSegmentation,1,"left lung")
-                elif self.engineAI == "lungmask LTRCLobes":
-                    self.showStatusMessage('Creating lungs and lobes with lungmask AI ...')
-                    if infer_mode == "mask": 
-                        model = mask.get_model('unet','LTRCLobes')
-                        segmentation_np = mask.apply(inputVolumeSitk, model)
-                    else: 
-                        inferer = LMInferer(modelname='LTRCLobes')
-                        segmentation_np = inferer.apply(inputVolumeSitk)
-                    # add lobe segments
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "left upper lobe", 1, self.inputVolume, self.leftUpperLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "left lower lobe", 2, self.inputVolume, self.leftLowerLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right upper lobe", 3, self.inputVolume, self.rightUpperLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right middle lobe", 4, self.inputVolume, self.rightMiddleLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right lower lobe", 5, self.inputVolume, self.rightLowerLobeColor)                    
-                    # Postprocess lobes
-                    self.postprocessSegment(self.outputSegmentation,0,"left upper lobe")
-                    self.postprocessSegment(self.outputSegmentation,1,"left lower lobe")
-                    self.postprocessSegment(self.outputSegmentation,2,"right upper lobe")
-                    self.postprocessSegment(self.outputSegmentation,3,"right middle lobe")
-                    self.postprocessSegment(self.outputSegmentation,4,"right lower lobe")
-                elif self.engineAI == "lungmask LTRCLobes_R231":
-                    self.showStatusMessage('Creating lungs and lobes with lungmask AI ...')
-                    if infer_mode == "mask": 
-                        segmentation_np = mask.apply_fused(inputVolumeSitk)
-                    else: 
-                        inferer = LMInferer(modelname='LTRCLobes', fillmodel='R231')
-                        segmentation_np = inferer.apply(inputVolumeSitk)                                   
-                    # add lobe segments
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "left upper lobe", 1, self.inputVolume, self.leftUpperLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "left lower lobe", 2, self.inputVolume, self.leftLowerLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right upper lobe", 3, self.inputVolume, self.rightUpperLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right middle lobe", 4, self.inputVolume, self.rightMiddleLobeColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right lower lobe", 5, self.inputVolume, self.rightLowerLobeColor)                    
-                    # Postprocess lobes
-                    self.postprocessSegment(self.outputSegmentation,0,"left upper lobe")
-                    self.postprocessSegment(self.outputSegmentation,1,"left lower lobe")
-                    self.postprocessSegment(self.outputSegmentation,2,"right upper lobe")
-                    self.postprocessSegment(self.outputSegmentation,3,"right middle lobe")
-                    self.postprocessSegment(self.outputSegmentation,4,"right lower lobe")
-                elif self.engineAI == "lungmask R231CovidWeb":
-                    self.showStatusMessage('Creating lungs with lungmask AI ...')
-                    if infer_mode == "mask": 
-                        model = mask.get_model('unet','R231CovidWeb')
-                        segmentation_np = mask.apply(inputVolumeSitk, model)
-                    else: 
-                        inferer = LMInferer(modelname='R231CovidWeb')
-                        segmentation_np = inferer.apply(inputVolumeSitk)
-                    # add lung segments
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "right lung", 1, self.inputVolume, self.rightLungColor)
-                    self.addSegmentFromNumpyArray(self.outputSegmentation, segmentation_np, "left lung", 2, self.inputVolume, self.leftLungColor)
-                    # Postprocess lungs 
-                    self.postprocessSegment(self.outputSegmentation,0,"right lung")
-                    self.postprocessSegment(self.outputSegmentation,1,"left lung")
+                lungSegments = [
+                    ("right lung", 1, self.rightLungColor),
+                    ("left lung", 2, self.leftLungColor),
+                    ]
+                lobeSegments = [
+                    ("left upper lobe", 1, self.leftUpperLobeColor),
+                    ("left lower lobe", 2, self.leftLowerLobeColor),
+                    ("right upper lobe", 3, self.rightUpperLobeColor),
+                    ("right middle lobe", 4, self.rightMiddleLobeColor),
+                    ("right lower lobe", 5, self.rightLowerLobeColor),
+                    ]
+                if self.engineAI in ("lungmask R231", "lungmask R231CovidWeb"):
+                    segments = lungSegments
+                elif self.engineAI in ("lungmask LTRCLobes", "lungmask LTRCLobes_R231"):
+                    segments = lobeSegments
                 else:
                     raise ValueError('This lungmask AI engine model is not supported.')
 
+                inputVolumeSitk = sitkUtils.PullVolumeFromSlicer(self.inputVolume)
+                # Inference result only depends on the input voxels/geometry, the model and the lungmask version
+                cacheFilePath = self.getLungmaskCacheFilePath(inputVolumeSitk, f"{self.engineAI} {current_version} {infer_mode}")
+                segmentation_np = self.loadLungmaskCache(cacheFilePath)
+                if segmentation_np is not None:
+                    self.showStatusMessage('Using cached lungmask AI result ...')
+                else:
+                    model = None
+                    inferer = None
+                    if self.engineAI == "lungmask R231":
+                        self.showStatusMessage('Creating lungs with lungmask AI ...')
+                        if infer_mode == "mask": 
+                            model = mask.get_model('unet','R231')
+                            segmentation_np = mask.apply(inputVolumeSitk, model)
+                        else: 
+                            inferer = LMInferer()
+                            segmentation_np = inferer.apply(inputVolumeSitk)                   
+                    elif self.engineAI == "lungmask LTRCLobes":
+                        self.showStatusMessage('Creating lungs and lobes with lungmask AI ...')
+                        if infer_mode == "mask": 
+                            model = mask.get_model('unet','LTRCLobes')
+                            segmentation_np = mask.apply(inputVolumeSitk, model)
+                        else: 
+                            inferer = LMInferer(modelname='LTRCLobes')
+                            segmentation_np = inferer.apply(inputVolumeSitk)
+                    elif self.engineAI == "lungmask LTRCLobes_R231":
+                        self.showStatusMessage('Creating lungs and lobes with lungmask AI ...')
+                        if infer_mode == "mask": 
+                            segmentation_np = mask.apply_fused(inputVolumeSitk)
+                        else: 
+                            inferer = LMInferer(modelname='LTRCLobes', fillmodel='R231')
+                            segmentation_np = inferer.apply(inputVolumeSitk)                                   
+                    elif self.engineAI == "lungmask R231CovidWeb":
+                        self.showStatusMessage('Creating lungs with lungmask AI ...')
+                        if infer_mode == "mask": 
+                            model = mask.get_model('unet','R231CovidWeb')
+                            segmentation_np = mask.apply(inputVolumeSitk, model)
+                        else: 
+                            inferer = LMInferer(modelname='R231CovidWeb')
+                            segmentation_np = inferer.apply(inputVolumeSitk)
+                    # release the model (GPU memory)
+                    del model, inferer
+                    self.saveLungmaskCache(cacheFilePath, segmentation_np)
+
+                # add lung or lobe segments
+                self.addSegmentsFromNumpyArray(self.outputSegmentation, segmentation_np, segments, self.inputVolume)
+
+                # release the label volume before post-processing
+                del segmentation_np, inputVolumeSitk
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+                # Postprocess lungs or lobes
+                for segmentIndex, (segmentName, _, _) in enumerate(segments):
+                    self.postprocessSegment(self.outputSegmentation, segmentIndex, segmentName)
                 
                 logging.info("Segmentation done.")
 
-            elif self.engineAI.find("TotalSegmentator") == 0:
+            elif self.engineAI.startswith("TotalSegmentator"):
                 self.increment_counter('counter_ts')
                 self.showStatusMessage(' Creating segmentations with TotalSegmentator ...')
                 tslogic = slicer.util.getModuleLogic('TotalSegmentator')
                 if not tslogic: 
                     raise RuntimeError("TotalSegmentator program logic not found - please install the TotalSegmentator extension.")
 
-                import shutil
-                import subprocess
-                versionInfo = subprocess.check_output([shutil.which('PythonSlicer'), "-m", "pip", "show", "TotalSegmentator"]).decode()
-                #print(versionInfo)      
-             
-                # Split the text into lines
-                #lines = versionInfo.split('\n')
-
-
                 self.tsOutputSegmentation = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'TotalSegmentator')
                 self.tsOutputExtendedSegmentation = None
                 if self.fastOption: 
@@ -2539,7 +2834,6 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 effect.self().onApply()
 
                 if muscleSegID:
-                    import SegmentStatistics
                     segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
                   
                     segStatLogic.getParameterNode().SetParameter("Segmentation", tempSegmentationNode.GetID())
@@ -2592,7 +2886,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                                                         
                 logging.info("Segmentation done.")
                 
-            elif self.engineAI.find("MONAILabel") == 0:
+            elif self.engineAI.startswith("MONAILabel"):
 
                 self.increment_counter('counter_ml')
                 _runScripted = False
@@ -2611,7 +2905,6 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                         print(MONAILabelClient)
                     except Exception as e:
                         slicer.util.errorDisplay("Unable to connect to MONAILabel server on http://127.0.0.1:8000"+str(e))
-                        import traceback
                         traceback.print_exc()
                     else:
                         # save the volume and get the path
@@ -2644,25 +2937,31 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 logging.info("No AI engine defined.")  
         
         
-        if not self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("right lung"): 
+        # Look up the lung segment IDs once and reuse them for the rest of the pipeline
+        segmentation = self.outputSegmentation.GetSegmentation()
+        rightLungID = segmentation.GetSegmentIdBySegmentName("right lung")
+        if not rightLungID: 
             # AI created right lobes only, so create lungs and add lobes 
             rightLungID = self.addSegment(self.outputSegmentation, "right lung", self.rightLungColor, 0.3)
             self.addSegmentToSegment(self.outputSegmentation, "right upper lobe", "right lung")
             self.addSegmentToSegment(self.outputSegmentation, "right middle lobe", "right lung")
             self.addSegmentToSegment(self.outputSegmentation, "right lower lobe", "right lung")
 
-        if not self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("left lung"): 
+        leftLungID = segmentation.GetSegmentIdBySegmentName("left lung")
+        if not leftLungID: 
             # AI created left lobes only, so create lungs and add lobes 
             leftLungID = self.addSegment(self.outputSegmentation, "left lung", self.leftLungColor, 0.3)
             self.addSegmentToSegment(self.outputSegmentation, "left upper lobe", "left lung")
             self.addSegmentToSegment(self.outputSegmentation, "left lower lobe", "left lung")
 
-        if not self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("thoracic cavity"): 
+        thoracicCavityID = segmentation.GetSegmentIdBySegmentName("thoracic cavity")
+        if not thoracicCavityID: 
             thoracicCavityID = self.addSegment(self.outputSegmentation, "thoracic cavity", self.thoracicCavityColor, 0.3)        
             self.addSegmentToSegment(self.outputSegmentation, "right lung", "thoracic cavity")
             self.addSegmentToSegment(self.outputSegmentation, "left lung", "thoracic cavity")
     
-        if not self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("lungs"): 
+        lungsID = segmentation.GetSegmentIdBySegmentName("lungs")
+        if not lungsID: 
             lungsID = self.addSegment(self.outputSegmentation, "lungs", self.rightLungColor, 0.3)        
             self.addSegmentToSegment(self.outputSegmentation, "right lung", "lungs")
             self.addSegmentToSegment(self.outputSegmentation, "left lung", "lungs")
@@ -2676,7 +2975,6 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             
             airwaySegID = self.addSegment(self.outputSegmentation, "airways", self.tracheaColor)
 
-            import SegmentStatistics
             segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
           
             segStatLogic.getParameterNode().SetParameter("Segmentation", self.outputSegmentation.GetID())
@@ -2688,10 +2986,8 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             stats = segStatLogic.getStatistics()
             # print(stats)
            
-            segID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("right lung")
-            medianRightLung = stats[segID,"ScalarVolumeSegmentStatisticsPlugin.median"]
-            segID = self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("left lung")
-            medianLeftLung = stats[segID,"ScalarVolumeSegmentStatisticsPlugin.median"]
+            medianRightLung = stats[rightLungID,"ScalarVolumeSegmentStatisticsPlugin.median"]
+            medianLeftLung = stats[leftLungID,"ScalarVolumeSegmentStatisticsPlugin.median"]
             
             self.medianLungs = (medianRightLung + medianLeftLung) / 2.
             print("Median radiodensity of lungs = {0:.2f}".format(self.medianLungs) + " HU")
@@ -2704,7 +3000,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 # self.segmentEditorNode = self.segmentEditorWidget.mrmlSegmentEditorNode()
                 wasModified = self.outputSegmentation.StartModify()
                 self.segmentEditorWidget.setSegmentationNode(self.outputSegmentation)
-                if self.calibrateData and self.useAI and self.engineAI.find("TotalSegmentator") == 0: 
+                if self.calibrateData and self.useAI and self.engineAI.startswith("TotalSegmentator"): 
                     self.outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(self.calibratedInputVolumeNode)
                     self.segmentEditorWidget.setSourceVolumeNode(self.calibratedInputVolumeNode)
                 else: 
@@ -2732,22 +3028,14 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 print("MaximumThreshold: " + str(self.medianLungs))
                 print("MinimumThreshold: " + str(scalarRange[0]))
                                 
-                if self.airwaySegmentationDetailLevel == "very low detail":
-                    effect.setParameter("MinimumDiameterMm","5")
-                if self.airwaySegmentationDetailLevel == "low detail":
-                    effect.setParameter("MinimumDiameterMm","4")
-                if self.airwaySegmentationDetailLevel == "medium low detail":
-                    effect.setParameter("MinimumDiameterMm","3")
-                elif self.airwaySegmentationDetailLevel == "medium detail":
-                    effect.setParameter("MinimumDiameterMm","2")
-                elif self.airwaySegmentationDetailLevel == "high detail":
-                    effect.setParameter("MinimumDiameterMm","1")
+                minimumDiameterMm = AIRWAY_DETAIL_LEVEL_MINIMUM_DIAMETER_MM.get(self.airwaySegmentationDetailLevel)
+                if minimumDiameterMm:
+                    effect.setParameter("MinimumDiameterMm", minimumDiameterMm)
                     
                 effect.setParameter("SegmentationAlgorithm","GrowCut")
                 # do not modify lungs by airways to avoid postprocessing (tumor-like) effects on lung mask
                 self.segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone) 
                 self.segmentEditorNode.SetMaskMode(slicer.vtkMRMLSegmentationNode.EditAllowedEverywhere)
-                import numpy as np
                 markupsIndex = 0
                 
                 # Get point coordinate in RAS
@@ -2763,7 +3051,7 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 volumeRasToIjk = vtk.vtkMatrix4x4()
                 self.inputVolume.GetRASToIJKMatrix(volumeRasToIjk)
                 point_Ijk = [0, 0, 0, 1]
-                volumeRasToIjk.MultiplyPoint(np.append(point_VolumeRas,1.0), point_Ijk)
+                volumeRasToIjk.MultiplyPoint((*point_VolumeRas, 1.0), point_Ijk)
                 point_Ijk = [ int(round(c)) for c in point_Ijk[0:3] ]
 
                 # Print output
@@ -2789,27 +3077,16 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
                 effect.setParameter("JointTaubinSmoothingFactor","0.5")
                 effect.self().onApply()
                 
-            segment = self.outputSegmentation.GetSegmentation().GetSegment(airwaySegID)
-            segment.SetTag(segment.GetTerminologyEntryTagName(),
-              "Segmentation category and type - 3D Slicer General Anatomy list"
-              "~SCT^123037004^Anatomical Structure"
-              "~SCT^44567001^Trachea"
-              "~^^"
-              "~Anatomic codes - DICOM master list"
-              "~^^"
-              "~^^")
+            self.setAnatomicalTag(self.outputSegmentation, "airways", airwaySegID)
             
         # create segments for both lungs, vessel and tumor segmentation
-        vesselMaskID = self.addSegment(self.outputSegmentation, "vesselmask", self.vesselmaskColor, 1.0)
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(vesselMaskID,False)
-        PASegmentID = self.addSegment(self.outputSegmentation, "PA", self.PAColor, 1.0)
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(PASegmentID,False)
-        PVSegmentID = self.addSegment(self.outputSegmentation, "PV", self.PVColor, 1.0)
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(PVSegmentID,False)
-        tumorSegmentID = self.addSegment(self.outputSegmentation, "tumor", self.tumorColor, 1.0)
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(tumorSegmentID,False)
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(thoracicCavityID,False)
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(lungsID,False)
+        with batchedModify(self.outputSegmentation.GetDisplayNode()) as displayNode:
+            vesselMaskID = self.addSegment(self.outputSegmentation, "vesselmask", self.vesselmaskColor, 1.0)
+            PASegmentID = self.addSegment(self.outputSegmentation, "PA", self.PAColor, 1.0)
+            PVSegmentID = self.addSegment(self.outputSegmentation, "PV", self.PVColor, 1.0)
+            tumorSegmentID = self.addSegment(self.outputSegmentation, "tumor", self.tumorColor, 1.0)
+            for segmentId in [vesselMaskID, PASegmentID, PVSegmentID, tumorSegmentID, thoracicCavityID, lungsID]:
+                displayNode.SetSegmentVisibility(segmentId,False)
 
         self.segmentEditorWidget.mrmlSegmentEditorNode().SetMasterVolumeIntensityMask(False)
         intensityRange = [0,0]
@@ -2921,30 +3198,31 @@ class LungCTSegmenterLogic(ScriptedLoadableModuleLogic):
             threeDView = threeDWidget.threeDView()
             threeDView.resetFocalPoint()
 
-        # Do not show lungs when in AI mode and when have lobes
-        if self.useAI: 
-            if self.outputSegmentation.GetSegmentation().GetSegmentIdBySegmentName("right upper lobe"):
-                segmentation = self.outputSegmentation.GetSegmentation()
-                rightLungID = segmentation.GetSegmentIdBySegmentName("right lung")
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(rightLungID,False)
-                leftLungID = segmentation.GetSegmentIdBySegmentName("left lung")
-                self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(leftLungID,False)
-                
-        # Never show both lungs initially 
-        segmentation = self.outputSegmentation.GetSegmentation()
-        lungsID = segmentation.GetSegmentIdBySegmentName("lungs")
-        self.outputSegmentation.GetDisplayNode().SetSegmentVisibility(lungsID,False)
-
-        # Restore confirmation popup setting for editing a hidden segment
-        if not self.useAI: 
-            slicer.app.settings().setValue("Segmentations/ConfirmEditHiddenSegment", previousConfirmEditHiddenSegmentSetting)
-
-        import gc
-        gc.collect()
-
-        slicer.mrmlScene.RemoveNode(self.rightLungFiducials)
-        slicer.mrmlScene.RemoveNode(self.leftLungFiducials)
-        slicer.mrmlScene.RemoveNode(self.tracheaFiducials)
+        # Avoid repainting the views for each visibility change and node removal
+        slicer.app.pauseRender()
+        try:
+            # Never show both lungs initially 
+            hiddenSegmentIds = [lungsID]
+            # Do not show lungs when in AI mode and when have lobes
+            if self.useAI and segmentation.GetSegmentIdBySegmentName("right upper lobe"):
+                hiddenSegmentIds += [rightLungID, leftLungID]
+            with batchedModify(self.outputSegmentation.GetDisplayNode()) as displayNode:
+                for segmentId in hiddenSegmentIds:
+                    displayNode.SetSegmentVisibility(segmentId,False)
+
+            # Restore confirmation popup setting for editing a hidden segment
+            if not self.useAI: 
+                settings = slicer.app.settings()
+                if settings.value("Segmentations/ConfirmEditHiddenSegment") != previousConfirmEditHiddenSegmentSetting:
+                    settings.setValue("Segmentations/ConfirmEditHiddenSegment", previousConfirmEditHiddenSegmentSetting)
+
+            gc.collect()
+
+            slicer.mrmlScene.RemoveNode(self.rightLungFiducials)
+            slicer.mrmlScene.RemoveNode(self.leftLungFiducials)
+            slicer.mrmlScene.RemoveNode(self.tracheaFiducials)
+        finally:
+            slicer.app.resumeRender()
 
         self.showStatusMessage(' Cleaning up ...')
         self.removeTemporaryObjects()
@@ -2968,6 +3246,9 @@ class LungCTSegmenterTest(ScriptedLoadableModuleTest):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # Segment statistics logic shared by all tests, see getSegStatLogic
+    _segStatLogic = None
+
     def setUp(self):
         """ Do whatever is needed to reset the state - typically a scene clear will be enough.
         """
@@ -2977,113 +3258,143 @@ class LungCTSegmenterTest(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here.
         """
         self.setUp()
-        #self.test_LungCTSegmenterNormal()
-        slicer.mrmlScene.Clear(0)
+        self.test_LungCTSegmenterNormal()
+        self.setUp()
         self.test_LungCTSegmenterLungmaskAI()
+        self.setUp()
         self.test_LungCTSegmenterTotalSegmentatorAI()
 
-    def test_LungCTSegmenterNormal(self):
-        """ Ideally you should have several levels of tests.  At the lowest level
-        tests should exercise the functionality of the logic with different inputs
-        (both valid and invalid).  At higher levels your tests should emulate the
-        way the user would interact with your code and confirm that it still works
-        the way you intended.
-        One of the most important features of the tests is that it should alert other
-        developers when their changes will have an impact on the behavior of your
-        module.  For example, if a developer removes a feature that you depend on,
-        your test should break so they know that the feature is needed.
+    def loadCTChest(self):
+        """ Load the CTChest sample data set. Only the first call goes through SampleData,
+        later tests load the already downloaded file directly.
         """
-
-        self.delayDisplay("Starting the test")
-
-        # Get/create input data
-
-        import SampleData
-        #registerSampleData()
+        cachedPath = getattr(LungCTSegmenterTest, "_ctChestFilePath", None)
+        if cachedPath and os.path.exists(cachedPath):
+            return slicer.util.loadVolume(cachedPath, {"name": "CTChest"})
         inputVolume = SampleData.downloadSample('CTChest')
-        self.delayDisplay('Loaded test data set')
+        LungCTSegmenterTest._ctChestFilePath = inputVolume.GetStorageNode().GetFileName()
+        return inputVolume
 
+    def getSegStatLogic(self):
+        """ Return the segment statistics logic shared by the tests, so that the statistics plugins
+        are only instantiated once. Its parameter node is not in the scene, so it survives scene clears
+        and is reset by _configureSegStat.
+        """
+        if LungCTSegmenterTest._segStatLogic is None:
+            LungCTSegmenterTest._segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
+        return LungCTSegmenterTest._segStatLogic
+
+    def _configureSegStat(self, segStatLogic, segID, volID):
+        """ Set up segment statistics for the lung volume checks, with all
+        parameters changed in a single parameter node modification.
+        """
+        with batchedModify(segStatLogic.getParameterNode()) as parameterNode:
+            # Start from the plugin defaults, previous tests may have used the same parameter node
+            segStatLogic.setDefaultParameters(parameterNode, overwriteExisting=True)
+            parameterNode.SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled", "False")
+            parameterNode.SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_mm3.enabled", "False")
+            parameterNode.SetParameter("LabelmapSegmentStatisticsPlugin.enabled", "True")
+            parameterNode.SetParameter("Segmentation", segID)
+            parameterNode.SetParameter("ScalarVolume", volID)
+
+    def deleteClutterMarkers(self):
+        """ Remove leftover "_marker" fiducials in a single scene batch, so that
+        the subject hierarchy and markups widgets are only updated once.
+        """
         logging.info('Delete clutter markers ....')
-        allSegmentNodes = slicer.util.getNodes('vtkMRMLMarkupsFiducialNode*').values()
-        for ctn in allSegmentNodes:
-            #logging.info('Name:>' + ctn.GetName()+'<')
-            teststr = ctn.GetName()
-            if '_marker' in teststr:
-            #logging.info('Found:' + ctn.GetName())
-                slicer.mrmlScene.RemoveNode(ctn)
-                #break        
-        # Create new markers
-        markupsRightLungNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        markupsRightLungNode.SetName("R")
-        markupsLeftLungNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        markupsLeftLungNode.SetName("L")
-        markupsTracheaNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        markupsTracheaNode.SetName("T")
-
-        # add six fiducials each right and left
-        markupsRightLungNode.CreateDefaultDisplayNodes()
-        markupsRightLungNode.AddFiducial(50.,48.,-173.)
-        markupsRightLungNode.AddFiducial(96.,-2.,-173.)
-        markupsRightLungNode.AddFiducial(92.,-47.,-173.)
-        markupsRightLungNode.AddFiducial(47.,-22.,-52.)
-        markupsRightLungNode.AddFiducial(86.,-22.,-128.)
-        markupsRightLungNode.AddFiducial(104.,-22.,-189.)
-        
-        markupsLeftLungNode.CreateDefaultDisplayNodes()
-        markupsLeftLungNode.AddFiducial(-100.,29.,-173.)
-        markupsLeftLungNode.AddFiducial(-111.,-37.,-173.)
-        markupsLeftLungNode.AddFiducial(-76.,-85.,-173.)
-        markupsLeftLungNode.AddFiducial(-77.,22.,-55.)
-        markupsLeftLungNode.AddFiducial(-100.,-22.,-123.)
-        markupsLeftLungNode.AddFiducial(-119.,-22.,-127.)
-
-        # add one fiducial 
-        markupsTracheaNode.CreateDefaultDisplayNodes()
-        markupsTracheaNode.AddFiducial(-4.,-14.,-90.)
+        scene = slicer.mrmlScene
+        fiducialNodes = scene.GetNodesByClass("vtkMRMLMarkupsFiducialNode")
+        fiducialNodes.UnRegister(None)
+        markerNodes = [node for node in (fiducialNodes.GetItemAsObject(i) for i in range(fiducialNodes.GetNumberOfItems()))
+            if '_marker' in node.GetName()]
+        scene.StartState(scene.BatchProcessState)
+        try:
+            for markerNode in markerNodes:
+                scene.RemoveNode(markerNode)
+        finally:
+            scene.EndState(scene.BatchProcessState)
 
-        # Test the module logic
+    def createFiducials(self, name, points):
+        """ Create a markups fiducial node with the given control points (RAS).
+        """
+        markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+        markupsNode.SetName(name)
+        # Set all points in one call instead of growing the point list one by one
+        controlPoints = vtk.vtkPoints()
+        controlPoints.SetNumberOfPoints(len(points))
+        for i, point in enumerate(points):
+            controlPoints.SetPoint(i, point)
+        markupsNode.SetControlPointPositionsWorld(controlPoints)
+        # Set up the display pipeline once, after all points are added
+        markupsNode.CreateDefaultDisplayNodes()
+        return markupsNode
 
+    def _runSegmentationTest(self, expectedVolumes, **logicSettings):
+        """ Run the full segmentation pipeline with the given logic attributes and check the
+        volumes in the segment statistics table. expectedVolumes lists (segment name, volume)
+        in table row order.
+        """
         logic = LungCTSegmenterLogic()
 
         # Test algorithm 
         self.delayDisplay("Processing, please wait ...")
 
         logic.removeTemporaryObjects()
-        logic.rightLungFiducials = markupsRightLungNode
-        logic.leftLungFiducials = markupsLeftLungNode
-        logic.tracheaFiducials = markupsTracheaNode
-        
-        logic.startSegmentation()
-        logic.updateSegmentation()
-        logic.applySegmentation()
-        
-        #logic.process(inputVolume, -1000.,-200.,False)
+        for name, value in logicSettings.items():
+            setattr(logic, name, value)
+
+        logic.runFullPipeline()
+
         resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', '_maskResultsTable')
 
         # Compute statistics       
-        import SegmentStatistics
-        segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-       
-        segStatLogic.getParameterNode().SetParameter("Segmentation", logic.outputSegmentation.GetID())
-        segStatLogic.getParameterNode().SetParameter("ScalarVolume", logic.inputVolume.GetID())
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", "True")
-        segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled", "False")
-        segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_mm3.enabled", "False")
+        segStatLogic = self.getSegStatLogic()
+        self._configureSegStat(segStatLogic, logic.outputSegmentation.GetID(), logic.inputVolume.GetID())
         segStatLogic.computeStatistics()
         segStatLogic.exportToTable(resultsTableNode)
 
-        #resultsTableNode = slicer.util.getNode('_maskResultsTable')
-        _volumeRightLungMask = round(float(resultsTableNode.GetCellText(0,3)))
-        _volumeLeftLungMask = round(float(resultsTableNode.GetCellText(1,3)))
-        print(_volumeRightLungMask)
-        print(_volumeLeftLungMask)
         # assert vs known volumes of the chest CT dataset
-        self.assertEqual(_volumeRightLungMask, 3227) 
-        self.assertEqual(_volumeLeftLungMask, 3138)
-
+        table = resultsTableNode.GetTable()
+        for row, (segmentName, expectedVolume) in enumerate(expectedVolumes):
+            # make sure that the volume is compared for the right segment
+            self.assertEqual(table.GetValue(row,0).ToString(), segmentName)
+            volume = table.GetValue(row,3).ToDouble()
+            logging.debug("{0} volume = {1:.2f}".format(segmentName, volume))
+            self.assertAlmostEqual(volume, expectedVolume, delta=0.5, msg=segmentName)
 
         self.delayDisplay('Test passed')
 
+    def test_LungCTSegmenterNormal(self):
+        """ Ideally you should have several levels of tests.  At the lowest level
+        tests should exercise the functionality of the logic with different inputs
+        (both valid and invalid).  At higher levels your tests should emulate the
+        way the user would interact with your code and confirm that it still works
+        the way you intended.
+        One of the most important features of the tests is that it should alert other
+        developers when their changes will have an impact on the behavior of your
+        module.  For example, if a developer removes a feature that you depend on,
+        your test should break so they know that the feature is needed.
+        """
+
+        self.delayDisplay("Starting the test")
+
+        # Get/create input data
+
+        inputVolume = self.loadCTChest()
+        self.delayDisplay('Loaded test data set')
+
+        self.deleteClutterMarkers()
+        # Create new markers, six fiducials each right and left and one in the trachea
+        markupsRightLungNode = self.createFiducials("R", [[50.,48.,-173.], [96.,-2.,-173.], [92.,-47.,-173.], [47.,-22.,-52.], [86.,-22.,-128.], [104.,-22.,-189.]])
+        markupsLeftLungNode = self.createFiducials("L", [[-100.,29.,-173.], [-111.,-37.,-173.], [-76.,-85.,-173.], [-77.,22.,-55.], [-100.,-22.,-123.], [-119.,-22.,-127.]])
+        markupsTracheaNode = self.createFiducials("T", [[-4.,-14.,-90.]])
+
+        # Test the module logic
+
+        self._runSegmentationTest([("right lung", 3227), ("left lung", 3138)],
+            rightLungFiducials=markupsRightLungNode,
+            leftLungFiducials=markupsLeftLungNode,
+            tracheaFiducials=markupsTracheaNode)
 
     def test_LungCTSegmenterLungmaskAI(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -3101,27 +3412,12 @@ class LungCTSegmenterTest(ScriptedLoadableModuleTest):
 
         # Get/create input data
 
-        import SampleData
-        #registerSampleData()
-        inputVolume = SampleData.downloadSample('CTChest')
+        inputVolume = self.loadCTChest()
         self.delayDisplay('Loaded test data set')
 
-        logging.info('Delete clutter markers ....')
-        allSegmentNodes = slicer.util.getNodes('vtkMRMLMarkupsFiducialNode*').values()
-        for ctn in allSegmentNodes:
-            #logging.info('Name:>' + ctn.GetName()+'<')
-            teststr = ctn.GetName()
-            if '_marker' in teststr:
-            #logging.info('Found:' + ctn.GetName())
-                slicer.mrmlScene.RemoveNode(ctn)
-                #break        
+        self.deleteClutterMarkers()
         # Create new marker
-        markupsTracheaNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        markupsTracheaNode.SetName("T")
-
-        # add one fiducial 
-        markupsTracheaNode.CreateDefaultDisplayNodes()
-        markupsTracheaNode.AddFiducial(-4.,-14.,-90.)
+        markupsTracheaNode = self.createFiducials("T", [[-4.,-14.,-90.]])
 
         # Logic testing is disabled by default to not overload automatic build machines (pytorch is a huge package and computation
         # on CPU takes 5-10 minutes). Set testLogic to True to enable testing.
@@ -3130,52 +3426,13 @@ class LungCTSegmenterTest(ScriptedLoadableModuleTest):
 
             # Test the module logic
 
-            logic = LungCTSegmenterLogic()
-
-            # Test algorithm 
-            self.delayDisplay("Processing, please wait ...")
-
-            logic.removeTemporaryObjects()
-            logic.tracheaFiducials = markupsTracheaNode
-            logic.detailedAirways = False
-            logic.createVessels = False
-            
-            logic.useAI = True
-            logic.engineAI = "lungmask LTRCLobes"
-
-            logic.startSegmentation()
-            logic.updateSegmentation()
-            logic.applySegmentation()
-            
-            #logic.process(inputVolume, -1000.,-200.,False)
-            resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', '_maskResultsTable')
-
-            # Compute stats
-            
-            import SegmentStatistics
-            segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-           
-            segStatLogic.getParameterNode().SetParameter("Segmentation", logic.outputSegmentation.GetID())
-            segStatLogic.getParameterNode().SetParameter("ScalarVolume", logic.inputVolume.GetID())
-            segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", "True")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled", "False")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_mm3.enabled", "False")
-            segStatLogic.computeStatistics()
-            segStatLogic.exportToTable(resultsTableNode)
-
-            #resultsTableNode = slicer.util.getNode('_maskResultsTable')
-            _volumeLeftUpperLobe = round(float(resultsTableNode.GetCellText(0,3)))
-            _volumeLeftLowerLobe = round(float(resultsTableNode.GetCellText(1,3)))
-            _volumeRightUpperLobe = round(float(resultsTableNode.GetCellText(2,3)))
-            _volumeRightMiddleLobe = round(float(resultsTableNode.GetCellText(3,3)))
-            _volumeRightLowerLobe = round(float(resultsTableNode.GetCellText(4,3)))
-            # assert vs known volumes of lobes from the chest CT dataset
-            self.assertEqual(_volumeLeftUpperLobe, 1461) 
-            self.assertEqual(_volumeLeftLowerLobe, 1651)
-            self.assertEqual(_volumeRightUpperLobe, 1415)
-            self.assertEqual(_volumeRightMiddleLobe, 485)
-            self.assertEqual(_volumeRightLowerLobe, 1293)
-            self.delayDisplay('Test passed')
+            self._runSegmentationTest(
+                [("left upper lobe", 1461), ("left lower lobe", 1651), ("right upper lobe", 1415), ("right middle lobe", 485), ("right lower lobe", 1293)],
+                tracheaFiducials=markupsTracheaNode,
+                detailedAirways=False,
+                createVessels=False,
+                useAI=True,
+                engineAI="lungmask LTRCLobes")
         else:
             logging.warning("test_LungCTSegmenterLungmaskAI logic testing was skipped")
 
@@ -3195,9 +3452,7 @@ class LungCTSegmenterTest(ScriptedLoadableModuleTest):
 
         # Get/create input data
 
-        import SampleData
-        #registerSampleData()
-        inputVolume = SampleData.downloadSample('CTChest')
+        inputVolume = self.loadCTChest()
         self.delayDisplay('Loaded test data set')
 
         # Logic testing is disabled by default to not overload automatic build machines (pytorch is a huge package and computation
@@ -3207,52 +3462,13 @@ class LungCTSegmenterTest(ScriptedLoadableModuleTest):
 
             # Test the module logic
 
-            logic = LungCTSegmenterLogic()
-
-            # Test algorithm 
-            self.delayDisplay("Processing, please wait ...")
-
-            logic.removeTemporaryObjects()
-            logic.detailedAirways = True
-            logic.createVessels = False
-            logic.calibrateData = True
-            
-            logic.useAI = True
-            logic.fastOption = True
-            logic.engineAI = "TotalSegmentator lung basic"
-
-            logic.startSegmentation()
-            logic.updateSegmentation()
-            logic.applySegmentation()
-            
-            resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', '_maskResultsTable')
-
-            # Compute stats
-            
-            import SegmentStatistics
-            segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-           
-            segStatLogic.getParameterNode().SetParameter("Segmentation", logic.outputSegmentation.GetID())
-            segStatLogic.getParameterNode().SetParameter("ScalarVolume", logic.inputVolume.GetID())
-            segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", "True")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled", "False")
-            segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.volume_mm3.enabled", "False")
-            segStatLogic.computeStatistics()
-            segStatLogic.exportToTable(resultsTableNode)
-
-            #resultsTableNode = slicer.util.getNode('_maskResultsTable')
-            _volumeRightUpperLobe = round(float(resultsTableNode.GetCellText(0,3)))
-            _volumeRightMiddleLobe = round(float(resultsTableNode.GetCellText(1,3)))
-            _volumeRightLowerLobe = round(float(resultsTableNode.GetCellText(2,3)))
-            _volumeLeftUpperLobe = round(float(resultsTableNode.GetCellText(3,3)))
-            _volumeLeftLowerLobe = round(float(resultsTableNode.GetCellText(4,3)))
-            # assert vs known volumes of lobes from the chest CT dataset
-            self.assertEqual(_volumeRightUpperLobe, 1408) 
-            self.assertEqual(_volumeRightMiddleLobe, 488)
-            self.assertEqual(_volumeRightLowerLobe, 1301)
-            self.assertEqual(_volumeLeftUpperLobe, 1441)
-            self.assertEqual(_volumeLeftLowerLobe, 1647)
-
-            self.delayDisplay('Test passed')
+            self._runSegmentationTest(
+                [("right upper lobe", 1408), ("right middle lobe", 488), ("right lower lobe", 1301), ("left upper lobe", 1441), ("left lower lobe", 1647)],
+                detailedAirways=True,
+                createVessels=False,
+                calibrateData=True,
+                useAI=True,
+                fastOption=True,
+                engineAI="TotalSegmentator lung basic")
         else:
             logging.warning("test_TotalSegmentator1 logic testing was skipped")